@@ -2,13 +2,22 @@
 #
 # To run a script
 # ./run.sh [image:tag] [./script]
+#
+# The journals of ecs_deployer are kept on the host in $ECS_DEPLOYER_JOURNAL_DIR
+# (default ~/.ecs_deployer), so that an interrupted deployment can be resumed from
+# another container.
 
 set -euo pipefail
 
+JOURNAL_DIR="${ECS_DEPLOYER_JOURNAL_DIR:-$HOME/.ecs_deployer}"
+mkdir -p "$JOURNAL_DIR"
+
 docker run \
   -it \
   --rm \
   --env AWS_SECRET_ACCESS_KEY \
   --env AWS_ACCESS_KEY_ID \
   --env AWS_DEFAULT_REGION \
+  --volume "$JOURNAL_DIR:/var/lib/ecs_deployer" \
+  --env ECS_DEPLOYER_JOURNAL_DIR=/var/lib/ecs_deployer \
   "$@"
@@ -1,29 +1,118 @@
 from __future__ import print_function
+import hashlib
+import io
 import json
-import boto3
+import threading
+from botocore.exceptions import ClientError
 from helper import *
+from metrics import *
+from rate_limiter import *
+from template_diff import *
 
+# boto3 is imported and each client is created on first use, then shared by all threads.
+# Most runs only need some of the clients, and creating one costs as much as the rest of the startup.
 class AWS(object):
-    def __init__(self, region):
-        self.cf_resource = boto3.resource('cloudformation', region_name=region)
-        self.cf_client = boto3.client('cloudformation', region_name=region)
-        self.asg_client = boto3.client('autoscaling', region_name=region)
-        self.elb_client = boto3.client('elb', region_name=region)
-        self.ecs_client = boto3.client('ecs', region_name=region)
+    def __init__(self, region, metrics=None, rate_limiter=None, max_retries=None, session=None):
+        self.region = region
+        self.metrics = metrics or Metrics()
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.clients = {}
+        self.lock = threading.RLock()
+        self.uploaded_templates = set()
+        self.template_lock = threading.Lock()
+        self._session = session
 
-    def get_all_cf_stack_outputs(self):
-        stacks = self.cf_resource.stacks.all()
-        return { stack.stack_name: { output['OutputKey']: output['OutputValue'] for output in (stack.outputs or []) } for stack in stacks }
+    @property
+    def session(self):
+        with self.lock:
+            if self._session is None:
+                import boto3
+                self._session = boto3.session.Session()
+            return self._session
+
+    def get_config(self):
+        if self.max_retries is None:
+            return None
+        from botocore.config import Config
+        return Config(retries={'max_attempts': self.max_retries})
+
+    def get_client(self, service_name):
+        # boto3 sessions are not thread safe, clients are created one at a time
+        with self.lock:
+            if service_name not in self.clients:
+                self.clients[service_name] = self.create_client(service_name)
+            return self.clients[service_name]
+
+    def create_client(self, service_name):
+        return self.instrument(self.session.client(service_name, region_name=self.region, config=self.get_config()))
+
+    @property
+    def cf_client(self):
+        return self.get_client('cloudformation')
+
+    @property
+    def asg_client(self):
+        return self.get_client('autoscaling')
+
+    @property
+    def elb_client(self):
+        return self.get_client('elb')
+
+    @property
+    def elbv2_client(self):
+        return self.get_client('elbv2')
+
+    @property
+    def s3_client(self):
+        return self.get_client('s3')
+
+    @property
+    def ecs_client(self):
+        return self.get_client('ecs')
+
+    def instrument(self, client):
+        self.metrics.instrument(client)
+        if self.rate_limiter is not None:
+            self.rate_limiter.instrument(client)
+        return client
+
+    def get_cf_stack_outputs(self, stack_names):
+        def get_outputs(stack_name):
+            try:
+                stack = one(self.cf_client.describe_stacks(StackName=stack_name)['Stacks'])
+            except ClientError as e:
+                if 'does not exist' in e.response['Error']['Message']:
+                    return stack_name, None
+                raise
+            return stack_name, { output['OutputKey']: output['OutputValue'] for output in (stack.get('Outputs') or []) }
+
+        return dict(parallel_map(get_outputs, stack_names))
 
     def get_cf_stack(self, stack_name):
         return one(self.cf_client.describe_stacks(StackName=stack_name)['Stacks'])
 
-    def is_cf_stack_changed(self, existing_stack_name, new_template, new_inputs, new_tags):
-        existing_template = json.dumps(self.cf_client.get_template(StackName=existing_stack_name)['TemplateBody'], sort_keys=True)
-        template_sorted = json.dumps(json.loads(new_template), sort_keys=True)
+    def get_cf_template(self, stack_name):
+        # the parsed template, or None for a template which is not JSON
+        template = self.cf_client.get_template(StackName=stack_name)['TemplateBody']
+        if isinstance(template, basestring):
+            try:
+                return json.loads(template)
+            except ValueError:
+                return None
+        return template
 
-        input_keys_to_compare = set(parameter['ParameterKey'] for parameter in self.cf_client.get_template_summary(StackName=existing_stack_name)['Parameters'] if not parameter['NoEcho'])
-        existing_stack = one(self.cf_client.describe_stacks(StackName=existing_stack_name)['Stacks'])
+    def is_cf_stack_changed(self, existing_stack_name, new_template, new_inputs, new_tags, existing_stack=None):
+        existing_template = self.get_cf_template(existing_stack_name)
+        new_template = json.loads(new_template)
+        if existing_stack is None:
+            existing_stack = one(self.cf_client.describe_stacks(StackName=existing_stack_name)['Stacks'])
+
+        # the NoEcho parameters are read from the template, rather than with another call to get_template_summary
+        if existing_template is None:
+            input_keys_to_compare = set(parameter['ParameterKey'] for parameter in self.cf_client.get_template_summary(StackName=existing_stack_name)['Parameters'] if not parameter['NoEcho'])
+        else:
+            input_keys_to_compare = set(key for key, parameter in existing_template.get('Parameters', {}).iteritems() if str(parameter.get('NoEcho', 'false')).lower() != 'true')
         existing_inputs = sorted((p for p in existing_stack['Parameters'] if p['ParameterKey'] in input_keys_to_compare), key=lambda i: i['ParameterKey'])
         inputs_sorted = sorted((i for i in new_inputs if i['ParameterKey'] in input_keys_to_compare), key=lambda i: i['ParameterKey'])
 
@@ -34,18 +123,55 @@ class AWS(object):
         existing_tags = sorted(existing_stack['Tags'], key=lambda tag: tag['Key'])
         tags_sorted = sorted(new_tags, key=lambda tag: tag['Key'])
 
-        return {'template': existing_template != template_sorted,
+        return {'template': existing_template != new_template,
+                'existing_template': existing_template,
+                'new_template': new_template,
+                'resources': diff_resources(existing_template, new_template) if existing_template is not None else {},
                 'inputs': delta_keys,
                 'tags': existing_tags != tags_sorted }
 
-    def create_stack(self, args):
+    def upload_template(self, bucket, template, prefix='ecs_deployer/templates/'):
+        # Templates are stored under the hash of their content, so that the same template is
+        # uploaded once for all components, environments and runs. Returns the TemplateURL.
+        bucket = bucket.replace('{region}', self.region)
+        key = '{}{}.json'.format(prefix, hashlib.sha256(template).hexdigest())
+        with self.template_lock:
+            if (bucket, key) not in self.uploaded_templates:
+                try:
+                    self.s3_client.head_object(Bucket=bucket, Key=key)
+                    log('Template s3://{}/{} was uploaded before.'.format(bucket, key))
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+                        raise
+                    log('Uploading template to s3://{}/{} ({} bytes)...'.format(bucket, key, len(template)))
+                    # a managed transfer, streamed and uploaded in parts once large enough
+                    self.s3_client.upload_fileobj(io.BytesIO(template), bucket, key, ExtraArgs={'ContentType': 'application/json'})
+                self.uploaded_templates.add((bucket, key))
+        return 'https://{}.s3.{}.amazonaws.com/{}'.format(bucket, self.region, key)
+
+    def start_create_stack(self, args):
+        return self.cf_client.create_stack(**args)['StackId']
+
+    def wait_for_stack_create(self, stack_id):
         waiter = self.cf_client.get_waiter('stack_create_complete')
-        stack_id = self.cf_client.create_stack(**args)['StackId']
         waiter.wait(StackName=stack_id)
 
-    def update_stack(self, args):
+    def get_new_cf_stack_events(self, stack_id, seen_event_ids):
+        # events are returned newest first, stop paginating once we reach events we have seen
+        events = []
+        for page in self.cf_client.get_paginator('describe_stack_events').paginate(StackName=stack_id):
+            new_events = [e for e in page['StackEvents'] if e['EventId'] not in seen_event_ids]
+            events.extend(new_events)
+            if len(new_events) < len(page['StackEvents']):
+                break
+        seen_event_ids.update(e['EventId'] for e in events)
+        return list(reversed(events))
+
+    def start_update_stack(self, args):
+        return self.cf_client.update_stack(**args)['StackId']
+
+    def wait_for_stack_update(self, stack_id):
         waiter = self.cf_client.get_waiter('stack_update_complete')
-        stack_id = self.cf_client.update_stack(**args)['StackId']
         waiter.wait(StackName=stack_id)
 
     def delete_stack(self, stack_name):
@@ -68,23 +194,27 @@ class AWS(object):
     def set_desired_capacity(self, asg_name, desired_capacity):
         self.asg_client.set_desired_capacity(AutoScalingGroupName=asg_name, DesiredCapacity=desired_capacity)
 
-    def get_healthy_instance_count(self, asg_name):
-        asg = one(self.asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])['AutoScalingGroups'])
-        instances = asg['Instances']
-        healthy_instance_ids = {i['InstanceId'] for i in instances if i['HealthStatus'].upper() == 'HEALTHY'}
-        if len(asg['LoadBalancerNames']) > 0:
-            elb_instances = flatten(self.elb_client.describe_instance_health(LoadBalancerName=elb_name) for elb_name in asg['LoadBalancerNames'])
-            inservice_instance_ids = {i['InstanceId'] for i in elb_instances if i['State'].upper() == 'INSERVICE'}
-            healthy_instance_ids &= inservice_instance_ids
-        return len(healthy_instance_ids)
+    def get_elb_instance_states(self, elb_name):
+        instance_states = self.elb_client.describe_instance_health(LoadBalancerName=elb_name)['InstanceStates']
+        return {i['InstanceId']: i['State'] for i in instance_states}
+
+    def get_target_group_states(self, target_group_arn):
+        # an instance registered on several ports is only healthy when all of them are
+        states = {}
+        for target in self.elbv2_client.describe_target_health(TargetGroupArn=target_group_arn)['TargetHealthDescriptions']:
+            if states.get(target['Target']['Id'], 'healthy') == 'healthy':
+                states[target['Target']['Id']] = target['TargetHealth']['State']
+        return states
 
     def get_ecs_instances(self, cluster_name):
-        instance_arns = flatten(p['containerInstanceArns'] for p in self.ecs_client.get_paginator('list_container_instances').paginate(cluster=cluster_name, status='ACTIVE'))
-        response = self.ecs_client.describe_container_instances(cluster=cluster_name, containerInstances=instance_arns)
-        if len(response['failures']) > 0:
-            raise Exception("Failed to describe ECS container instances. {}".format(response['failures']))
+        def get_instances(arns):
+            response = self.ecs_client.describe_container_instances(cluster=cluster_name, containerInstances=arns)
+            if len(response['failures']) > 0:
+                raise Exception("Failed to describe ECS container instances. {}".format(response['failures']))
+            return response['containerInstances']
 
-        return response['containerInstances']
+        instance_arns = flatten(p['containerInstanceArns'] for p in self.ecs_client.get_paginator('list_container_instances').paginate(cluster=cluster_name, status='ACTIVE'))
+        return flatten(get_instances(arns) for arns in paginate(instance_arns, page_size=100))
 
     def get_ecs_tasks(self, cluster_name):
         def get_tasks(arns):
@@ -97,24 +227,76 @@ class AWS(object):
         tasks = flatten(get_tasks(arns) for arns in paginate(task_arns, page_size=100))
         return tasks
 
-    def get_ecs_task_arns_by_ecs_instance(self, cluster_name, instance_arn):
-        return flatten(p['taskArns'] for p in self.ecs_client.get_paginator('list_tasks').paginate(cluster=cluster_name, containerInstance=instance_arn, desiredStatus='RUNNING'))
+    def get_ecs_task_definition(self, task_definition_arn):
+        return self.ecs_client.describe_task_definition(taskDefinition=task_definition_arn)['taskDefinition']
 
-    def get_ecs_services(self, cluster_name):
+    def get_ecs_services(self, cluster_name, service_arns=None):
         def get_services(arns):
             response = self.ecs_client.describe_services(cluster=cluster_name, services=arns)
             if len(response['failures']) > 0:
                 raise Exception("Failed to describe ECS services. {}".format(response['failures']))
             return response['services']
 
-        service_arns = flatten(p['serviceArns'] for p in self.ecs_client.get_paginator('list_services').paginate(cluster=cluster_name))
+        if service_arns is None:
+            service_arns = flatten(p['serviceArns'] for p in self.ecs_client.get_paginator('list_services').paginate(cluster=cluster_name))
         services = flatten(get_services(arns) for arns in paginate(service_arns, page_size=10))
         return services
 
+    def force_new_ecs_deployment(self, cluster_name, service_arn):
+        # returns the id of the new deployment
+        service = self.ecs_client.update_service(cluster=cluster_name, service=service_arn, forceNewDeployment=True)['service']
+        return one(d for d in service['deployments'] if d['status'] == 'PRIMARY')['id']
+
     def drain_ecs_instances(self, cluster_name, instance_arns):
-        response = self.ecs_client.update_container_instances_state(cluster=cluster_name, containerInstances=instance_arns, status='DRAINING')
-        if len(response['failures']) > 0:
-            raise Exception("Failed to drain ECS instance. {}".format(response['failures']))
+        for arns in paginate(instance_arns, page_size=10):
+            response = self.ecs_client.update_container_instances_state(cluster=cluster_name, containerInstances=arns, status='DRAINING')
+            if len(response['failures']) > 0:
+                raise Exception("Failed to drain ECS instance. {}".format(response['failures']))
 
     def put_ecs_attributes(self, cluster_name, attributes):
-        self.ecs_client.put_attributes(cluster=cluster_name, attributes=attributes)
\ No newline at end of file
+        for page in paginate(attributes, page_size=10):
+            self.ecs_client.put_attributes(cluster=cluster_name, attributes=page)
+
+# Memo of stack outputs, keyed by stack name. Stacks are looked up on demand with targeted
+# describe_stacks calls, None is cached for stacks that do not exist. Entries are kept for
+# the whole run, or for max_age seconds when the memo outlives a run (server mode).
+class StackOutputs(object):
+    def __init__(self, aws, max_age=None):
+        self.aws = aws
+        self.max_age = max_age
+        self.outputs = {}
+        self.fetched_at = {}
+        self.lock = threading.Lock()
+
+    def is_fresh(self, stack_name, now):
+        return stack_name in self.outputs and (self.max_age is None or now - self.fetched_at[stack_name] < self.max_age)
+
+    def prefetch(self, stack_names):
+        now = time.time()
+        with self.lock:
+            missing = [stack_name for stack_name in set(stack_names) if not self.is_fresh(stack_name, now)]
+        if len(missing) > 0:
+            fetched = self.aws.get_cf_stack_outputs(missing)
+            with self.lock:
+                self.outputs.update(fetched)
+                self.fetched_at.update((stack_name, now) for stack_name in fetched)
+
+    def invalidate(self, stack_names):
+        with self.lock:
+            for stack_name in stack_names:
+                self.outputs.pop(stack_name, None)
+                self.fetched_at.pop(stack_name, None)
+
+    def get(self, stack_name):
+        self.prefetch([stack_name])
+        with self.lock:
+            return self.outputs.get(stack_name)
+
+    def __contains__(self, stack_name):
+        return self.get(stack_name) is not None
+
+    def __getitem__(self, stack_name):
+        outputs = self.get(stack_name)
+        if outputs is None:
+            raise KeyError(stack_name)
+        return outputs
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+#
+# Runs a blue/green replacement of an ECS cluster end to end against fake_aws, on a simulated
+# clock, and reports how long each phase took and which AWS calls it made. Use it to compare
+# changes to the deployment logic before trying them on a real cluster:
+#
+#   ./benchmark.py --scenario small medium --output before.json
+#   ./benchmark.py --scenario small medium --baseline before.json
+
+from __future__ import print_function
+import argparse
+import imp
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from helper import *
+from aws_helper import *
+from component import *
+from fake_aws import *
+from journal import *
+import aws_helper
+import capacity_planner
+import cluster_state
+import component
+import helper
+import instance_health
+import metrics
+import rate_limiter
+
+SCENARIOS = {
+    'small': {'instances': 10, 'services': 10, 'tasks': 200, 'drain_concurrency': '2'},
+    'medium': {'instances': 100, 'services': 50, 'tasks': 2000, 'drain_concurrency': '10'},
+    'large': {'instances': 500, 'services': 100, 'tasks': 10000, 'drain_concurrency': '10%'},
+}
+
+INSTANCE_TYPE = 'm4.xlarge'
+REGION = 'fake-region-1'
+ENVIRONMENT = 'benchmark'
+COMPONENT_NAME = 'cluster'
+CLUSTER_NAME = 'benchmark-cluster'
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark an ECS cluster replacement against a simulated AWS backend')
+    parser.add_argument('--scenario', nargs='+', default=['small', 'medium'], choices=sorted(SCENARIOS), help='scenario(s) to run')
+    parser.add_argument('--command', default='deploy', choices=['deploy', 'redeploy'], help='deploy replaces the cluster stack, redeploy restarts the tasks of every service in place')
+    parser.add_argument('--drain-concurrency', dest='drain_concurrency', help='override the drain concurrency of the scenarios')
+    parser.add_argument('--wave-size', dest='wave_size', default='25%', help='as ecs_deployer --wave-size, for --command redeploy')
+    parser.add_argument('--capacity-preflight', dest='capacity_preflight', default='scale', choices=['scale', 'fail', 'off'])
+    parser.add_argument('--api-rate-limit', dest='api_rate_limit', type=float, default=DEFAULT_RATE, help='client side rate limit, as ecs_deployer --api-rate-limit (default %(default)s). 0 to disable')
+    parser.add_argument('--api-max-retries', dest='api_max_retries', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-file', dest='log_file', default=os.devnull, help='where the deployment logs go, discarded by default')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown (simulated time or AWS calls) over the baseline that counts as a regression')
+    return parser.parse_args(argv)
+
+def load_ecs_deployer():
+    return imp.load_source('ecs_deployer', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ecs_deployer'))
+
+def use_clock(modules, clock):
+    # the deployer modules import time at module level, point them at the simulated clock
+    for module in modules:
+        if getattr(module, 'time', None) is time:
+            module.time = clock
+
+def restore_clock(modules):
+    for module in modules:
+        if isinstance(getattr(module, 'time', None), SimulatedClock):
+            module.time = time
+
+def get_template():
+    return json.dumps({
+        'Parameters': {
+            'ClusterName': {'Type': 'String'},
+            'InstanceType': {'Type': 'String'},
+            'ImageId': {'Type': 'String'},
+            'MinSize': {'Type': 'Number'},
+            'MaxSize': {'Type': 'Number'}
+        },
+        'Resources': {
+            'LaunchConfiguration': {
+                'Type': 'AWS::AutoScaling::LaunchConfiguration',
+                'Properties': {'ImageId': {'Ref': 'ImageId'}, 'InstanceType': {'Ref': 'InstanceType'}}
+            },
+            'AutoScalingGroup': {
+                'Type': 'AWS::AutoScaling::AutoScalingGroup',
+                'Metadata': {'ECSCluster': {'Ref': 'ClusterName'}, 'InstanceType': {'Ref': 'InstanceType'}},
+                'Properties': {'LaunchConfigurationName': {'Ref': 'LaunchConfiguration'}, 'MinSize': {'Ref': 'MinSize'}, 'MaxSize': {'Ref': 'MaxSize'},
+                               'TargetGroupARNs': [{'Ref': 'TargetGroup'}]}
+            },
+            # the target group reports the instances as unused until the listener exists, long after the auto scaling group
+            'TargetGroup': {
+                'Type': 'AWS::ElasticLoadBalancingV2::TargetGroup',
+                'Properties': {'Port': 80, 'Protocol': 'HTTP'}
+            },
+            'LoadBalancer': {
+                'Type': 'AWS::ElasticLoadBalancingV2::LoadBalancer',
+                'Properties': {'Scheme': 'internal'}
+            },
+            'Listener': {
+                'Type': 'AWS::ElasticLoadBalancingV2::Listener',
+                'Properties': {'LoadBalancerArn': {'Ref': 'LoadBalancer'}, 'Port': 80, 'Protocol': 'HTTP',
+                               'DefaultActions': [{'Type': 'forward', 'TargetGroupArn': {'Ref': 'TargetGroup'}}]}
+            }
+        },
+        'Outputs': {
+            'AutoScalingGroupName': {'Value': {'Ref': 'AutoScalingGroup'}},
+            'ClusterName': {'Value': {'Ref': 'ClusterName'}}
+        }
+    }, indent=2, sort_keys=True)
+
+def get_config(config_dir, scenario):
+    return {
+        ':components': {
+            ':' + COMPONENT_NAME: {
+                ':settings': {
+                    ':application': 'benchmark',
+                    ':component': COMPONENT_NAME,
+                    ':environment': ENVIRONMENT,
+                    ':region': REGION,
+                    ':auto-scaling-group-name-output': ['AutoScalingGroupName'],
+                    ':ecs-cluster-name-output': ['ClusterName']
+                },
+                ':inputs': {
+                    ':application': 'benchmark',
+                    ':component': COMPONENT_NAME,
+                    ':environment': ENVIRONMENT,
+                    ':region': REGION,
+                    ':ClusterName': CLUSTER_NAME,
+                    ':InstanceType': INSTANCE_TYPE,
+                    ':ImageId': 'ami-new',
+                    ':MinSize': 1,
+                    ':MaxSize': scenario['instances'] * 2
+                },
+                ':config_dir': config_dir
+            }
+        }
+    }
+
+def create_existing_cluster(backend, scenario, stack_name):
+    template = get_template()
+    stack = backend.create_stack_now(stack_name, template, {
+        'ClusterName': CLUSTER_NAME,
+        'InstanceType': INSTANCE_TYPE,
+        'ImageId': 'ami-old',
+        'MinSize': '1',
+        'MaxSize': str(scenario['instances'] * 2)
+    })
+    backend.scale_asg(stack['PhysicalIds']['AutoScalingGroup'], scenario['instances'], backend.clock.time(), instances_ready=True)
+
+    # one service bound to a static host port on half of the instances, the other tasks spread over the remaining services
+    task_definition_arn = backend.register_task_definition('web', cpu=256, memory=1024, host_port=80)
+    backend.create_service(CLUSTER_NAME, 'web', task_definition_arn, scenario['instances'] / 2)
+    tasks = scenario['tasks'] - scenario['instances'] / 2
+    for i in xrange(scenario['services']):
+        task_definition_arn = backend.register_task_definition('worker-{}'.format(i), cpu=128, memory=512)
+        backend.create_service(CLUSTER_NAME, 'worker-{}'.format(i), task_definition_arn, tasks / scenario['services'] + (1 if i < tasks % scenario['services'] else 0))
+    return stack
+
+def verify(backend, scenario, existing_stack):
+    # every task must have been moved to the new instances, and the existing stack deleted
+    cluster = backend.get_cluster(CLUSTER_NAME)
+    if existing_stack['StackName'] in backend.stacks:
+        raise Exception('Stack {} has not been deleted'.format(existing_stack['StackName']))
+    if len(cluster['tasks']) != scenario['tasks']:
+        raise Exception('{} tasks are running, {} expected'.format(len(cluster['tasks']), scenario['tasks']))
+    stranded = [t for t in cluster['tasks'].itervalues() if cluster['instances'][t['containerInstanceArn']]['status'] != 'ACTIVE']
+    if len(stranded) > 0:
+        raise Exception('{} tasks are still running on drained instances'.format(len(stranded)))
+
+def verify_redeploy(backend, scenario):
+    # every task must have been replaced by a task of the new deployment of its service
+    cluster = backend.get_cluster(CLUSTER_NAME)
+    if len(cluster['tasks']) != scenario['tasks']:
+        raise Exception('{} tasks are running, {} expected'.format(len(cluster['tasks']), scenario['tasks']))
+    old_tasks = [arn for service in cluster['services'].itervalues() for arn in service['_old_tasks'] if arn in cluster['tasks']]
+    if len(old_tasks) > 0:
+        raise Exception('{} tasks of the previous deployments are still running'.format(len(old_tasks)))
+
+def run_scenario(name, args):
+    scenario = dict(SCENARIOS[name])
+    if args.drain_concurrency:
+        scenario['drain_concurrency'] = args.drain_concurrency
+
+    random.seed(args.seed)
+    clock = SimulatedClock()
+    backend = FakeBackend(clock, seed=args.seed)
+    ecs_deployer = load_ecs_deployer()
+    modules = [helper, metrics, rate_limiter, aws_helper, cluster_state, capacity_planner, component, instance_health, ecs_deployer]
+    config_dir = tempfile.mkdtemp()
+    started_at = time.time()
+    use_clock(modules, clock)
+    try:
+        with open(os.path.join(config_dir, COMPONENT_NAME + '.json'), 'w') as f:
+            f.write(get_template())
+        config = get_config(config_dir, scenario)
+        existing_stack = create_existing_cluster(backend, scenario, 'benchmark-{}-{}-B'.format(ENVIRONMENT, COMPONENT_NAME))
+
+        rate_limiter_ = RateLimiter(rate=args.api_rate_limit) if args.api_rate_limit > 0 else None
+        aws = AWS(REGION, rate_limiter=rate_limiter_, max_retries=args.api_max_retries, session=FakeSession(backend))
+        stack_outputs = StackOutputs(aws)
+        error = None
+        try:
+            c = Component(config=config, name=COMPONENT_NAME, environment=ENVIRONMENT, region=REGION, stack_outputs=stack_outputs)
+            journal = Journal(os.path.join(config_dir, 'journal.jsonl'))
+            if args.command == 'redeploy':
+                ecs_deployer.redeploy(component=c, aws=aws, stack_outputs=stack_outputs, dryrun=False, wave_size=args.wave_size, concurrency=10, wave_timeout=900, journal=journal)
+                verify_redeploy(backend, scenario)
+            else:
+                ecs_deployer.deploy(component=c, aws=aws, stack_outputs=stack_outputs, dryrun=False, size_parameters=['MinSize', 'MaxSize'],
+                                    drain_concurrency=scenario['drain_concurrency'], capacity_preflight=args.capacity_preflight, journal=journal)
+                verify(backend, scenario, existing_stack)
+        except Exception as e:
+            log(traceback.format_exc().rstrip(), level='ERROR')
+            error = str(e)
+    finally:
+        clock.stop()
+        restore_clock(modules)
+        shutil.rmtree(config_dir)
+
+    report = aws.metrics.get_report()
+    operations = report['operations']
+    return {
+        'scenario': name if args.command == 'deploy' else '{} {}'.format(name, args.command),
+        'instances': scenario['instances'],
+        'tasks': scenario['tasks'],
+        'drain_concurrency': scenario['drain_concurrency'],
+        'api_rate_limit': args.api_rate_limit,
+        'succeeded': error is None,
+        'error': error,
+        'simulated_seconds': round(clock.elapsed(), 1),
+        'wall_seconds': round(time.time() - started_at, 1),
+        'calls': sum(o['calls'] for o in operations),
+        'retries': sum(o['retries'] for o in operations),
+        'throttles': sum(o['throttles'] for o in operations),
+        'phases': [{'phase': p['phase'], 'seconds': p['seconds'], 'succeeded': p['succeeded']} for p in report['phases']],
+        'operations': [{k: o[k] for k in ['service', 'operation', 'calls', 'retries', 'throttles']} for o in operations]
+    }
+
+def print_result(result):
+    log('Scenario {}: {} instances, {} tasks, drain concurrency {}: {} after {:.0f}s simulated ({:.0f}s wall clock)'.format(
+        result['scenario'], result['instances'], result['tasks'], result['drain_concurrency'],
+        'succeeded' if result['succeeded'] else 'FAILED ({})'.format(result['error']), result['simulated_seconds'], result['wall_seconds']))
+    for phase in result['phases']:
+        log('  phase {}: {:.0f}s'.format(phase['phase'], phase['seconds']))
+    log('  {} AWS calls, {} retries, {} throttles'.format(result['calls'], result['retries'], result['throttles']))
+    for o in sorted(result['operations'], key=lambda o: o['calls'], reverse=True):
+        log('    {}.{}: {} calls, {} retries, {} throttles'.format(o['service'], o['operation'], o['calls'], o['retries'], o['throttles']))
+
+def compare(results, baseline, tolerance):
+    # returns the regressions against the baseline results of the same scenarios
+    regressions = []
+    baseline = {r['scenario']: r for r in baseline}
+    for result in results:
+        previous = baseline.get(result['scenario'])
+        if previous is None:
+            continue
+        for key in ['simulated_seconds', 'calls', 'throttles']:
+            if result[key] > previous[key] * (1 + tolerance) and result[key] - previous[key] >= 1:
+                regressions.append('{} {}: {} (baseline {})'.format(result['scenario'], key, result[key], previous[key]))
+        if previous['succeeded'] and not result['succeeded']:
+            regressions.append('{} failed: {}'.format(result['scenario'], result['error']))
+    return regressions
+
+def main():
+    args = get_args()
+    results = []
+    for name in args.scenario:
+        log('Running scenario {}...'.format(name))
+        stdout = sys.stdout
+        with open(args.log_file, 'a') as f:
+            sys.stdout = f
+            try:
+                result = run_scenario(name, args)
+            finally:
+                sys.stdout = stdout
+        print_result(result)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=2)
+        log('Results written to {}'.format(args.output))
+
+    failed = [r['scenario'] for r in results if not r['succeeded']]
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            log('Regression: {}'.format(regression), level='ERROR')
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
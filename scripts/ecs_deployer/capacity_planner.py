@@ -0,0 +1,109 @@
+from __future__ import print_function
+from helper import *
+
+# Simulates placing the tasks of the existing ECS instances onto the instances of the new
+# auto scaling group before draining, to find out how many new instances are required.
+#
+# Only CPU, memory and static host ports are considered. Placement constraints and strategies
+# are not, so the result is a lower bound for clusters relying on them.
+
+def get_resources(resources):
+    by_name = {r['name']: r for r in resources}
+    ports = set()
+    for name, protocol in [('PORTS', 'tcp'), ('PORTS_UDP', 'udp')]:
+        ports |= {(protocol, port) for port in by_name.get(name, {}).get('stringSetValue', [])}
+    return {
+        'cpu': by_name.get('CPU', {}).get('integerValue', 0),
+        'memory': by_name.get('MEMORY', {}).get('integerValue', 0),
+        'ports': ports
+    }
+
+def get_task_requirements(task_definition):
+    containers = task_definition['containerDefinitions']
+    cpu = sum(c.get('cpu', 0) for c in containers)
+    memory = sum(c.get('memoryReservation') or c.get('memory') or 0 for c in containers)
+    if task_definition.get('cpu'):
+        cpu = max(cpu, int(task_definition['cpu']))
+    if task_definition.get('memory'):
+        memory = max(memory, int(task_definition['memory']))
+    ports = {(m.get('protocol', 'tcp'), str(m['hostPort'])) for c in containers for m in c.get('portMappings', []) if m.get('hostPort')}
+    return {'cpu': cpu, 'memory': memory, 'ports': ports}
+
+def fits(instance, requirements):
+    return instance['cpu'] >= requirements['cpu'] \
+        and instance['memory'] >= requirements['memory'] \
+        and not (instance['ports'] & requirements['ports'])
+
+def place(instance, requirements):
+    instance['cpu'] -= requirements['cpu']
+    instance['memory'] -= requirements['memory']
+    instance['ports'] = instance['ports'] | requirements['ports']
+
+def empty_instance(registered, daemon_requirements):
+    instance = dict(registered, ports=set(registered['ports']))
+    for requirements in daemon_requirements:
+        place(instance, requirements)
+    return instance
+
+def simulate_placement(task_requirements, instances, registered, daemon_requirements):
+    # first fit decreasing, opening a new (empty) instance whenever no instance fits the task.
+    # Returns the number of extra instances needed and the tasks that cannot fit any instance.
+    instances = [dict(i, ports=set(i['ports'])) for i in instances]
+    extra_instance_count = 0
+    unplaceable = []
+
+    for requirements in sorted(task_requirements, key=lambda r: (r['memory'], r['cpu'], len(r['ports'])), reverse=True):
+        instance = next((i for i in instances if fits(i, requirements)), None)
+        if instance is None:
+            instance = empty_instance(registered, daemon_requirements)
+            if not fits(instance, requirements):
+                unplaceable.append(requirements)
+                continue
+            instances.append(instance)
+            extra_instance_count += 1
+        place(instance, requirements)
+
+    return extra_instance_count, unplaceable
+
+def get_task_definitions(task_definition_arns, aws):
+    return dict(parallel_map(lambda arn: (arn, aws.get_ecs_task_definition(arn)), sorted(set(task_definition_arns))))
+
+def plan_capacity(cluster_name, existing_instance_ids, new_asg, cluster_state, aws):
+    # returns the desired capacity the new auto scaling group needs to host the tasks of the
+    # existing instances, or None if there is no registered new instance to plan with.
+    ecs_instances = aws.get_ecs_instances(cluster_name=cluster_name)
+    new_instance_ids = {i['InstanceId'] for i in new_asg['Instances']}
+    existing_instance_arns = {i['containerInstanceArn'] for i in ecs_instances if i['ec2InstanceId'] in existing_instance_ids}
+    new_ecs_instances = [i for i in ecs_instances if i['ec2InstanceId'] in new_instance_ids]
+    if len(new_ecs_instances) == 0:
+        return None
+
+    # daemon tasks are started on every instance by ECS, they only reserve resources on new instances
+    daemon_service_names = {s['serviceName'] for s in aws.get_ecs_services(cluster_name=cluster_name) if s.get('schedulingStrategy') == 'DAEMON'}
+    def get_service_name(task):
+        group = task.get('group', '')
+        return group[len('service:'):] if group.startswith('service:') else None
+
+    # only service tasks are rescheduled when an instance is drained
+    tasks_to_place = [t for t in cluster_state.tasks
+                      if t.get('containerInstanceArn') in existing_instance_arns
+                      and get_service_name(t) is not None
+                      and get_service_name(t) not in daemon_service_names]
+    daemon_tasks = {get_service_name(t): t for t in cluster_state.tasks if get_service_name(t) in daemon_service_names}
+
+    task_definitions = get_task_definitions([t['taskDefinitionArn'] for t in tasks_to_place + daemon_tasks.values()], aws)
+    task_requirements = [get_task_requirements(task_definitions[t['taskDefinitionArn']]) for t in tasks_to_place]
+    daemon_requirements = [get_task_requirements(task_definitions[t['taskDefinitionArn']]) for t in daemon_tasks.values()]
+
+    registered = max((get_resources(i['registeredResources']) for i in new_ecs_instances), key=lambda r: (r['memory'], r['cpu']))
+    instances = [get_resources(i['remainingResources']) for i in new_ecs_instances]
+    # instances of the new auto scaling group which have not registered yet will come up empty
+    instances += [empty_instance(registered, daemon_requirements) for _ in xrange(len(new_instance_ids) - len(new_ecs_instances))]
+
+    extra_instance_count, unplaceable = simulate_placement(task_requirements, instances, registered, daemon_requirements)
+    if len(unplaceable) > 0:
+        raise Exception('{} tasks require more resources than an instance of auto scaling group {} provides: {}'.format(len(unplaceable), new_asg['AutoScalingGroupName'], unplaceable))
+
+    required_capacity = len(new_instance_ids) + extra_instance_count
+    log('Capacity planning: {} tasks to transfer onto {} new instances, {} instances required.'.format(len(tasks_to_place), len(new_instance_ids), required_capacity))
+    return required_capacity
@@ -0,0 +1,30 @@
+from __future__ import print_function
+import collections
+from helper import *
+
+# Snapshot of the RUNNING tasks of an ECS cluster, indexed by container instance.
+# A refresh costs one paginated list_tasks plus one describe_tasks per 100 tasks,
+# no matter how many container instances are being watched.
+class ClusterState(object):
+    def __init__(self, cluster_name, aws):
+        self.cluster_name = cluster_name
+        self.aws = aws
+        self.tasks = []
+        self.tasks_by_instance = {}
+        self.refreshed_at = None
+
+    def refresh(self):
+        refreshed_at = time.time()
+        self.tasks = self.aws.get_ecs_tasks(cluster_name=self.cluster_name)
+        tasks_by_instance = collections.defaultdict(list)
+        for task in self.tasks:
+            tasks_by_instance[task.get('containerInstanceArn')].append(task)
+        self.tasks_by_instance = dict(tasks_by_instance)
+        self.refreshed_at = refreshed_at
+        return self
+
+    def get_tasks(self, instance_arn):
+        return self.tasks_by_instance.get(instance_arn, [])
+
+    def get_task_count(self, instance_arn):
+        return len(self.get_tasks(instance_arn))
@@ -2,6 +2,31 @@ from __future__ import print_function
 import collections
 from helper import *
 
+def matches_region(section, region):
+    # a section is valid for its :region, or for every region of an optional :regions list
+    return section.get(':region') == region or region in section.get(':regions', [])
+
+def get_referenced_components(config, name):
+    inputs = config[':components'][':' + name].get(':inputs', {})
+    return sorted(set(v[':component'] for v in inputs.itervalues() if isinstance(v, dict) and ':component' in v and ':output-key' in v))
+
+def get_component_dependencies(config, names):
+    # only dependencies between the given components matter, others are expected to be deployed already
+    dependencies = { name: set(get_referenced_components(config, name)) & set(names) for name in names }
+
+    visited = set()
+    def visit(name, path):
+        if name in path:
+            raise Exception("Circular dependency between components: {}".format(' -> '.join(path + [name])))
+        if name not in visited:
+            for dependency in sorted(dependencies[name]):
+                visit(dependency, path + [name])
+            visited.add(name)
+
+    for name in sorted(names):
+        visit(name, [])
+    return dependencies
+
 class Component(object):
     def __init__(self, config, name, environment, region, stack_outputs):
         self.config = config
@@ -18,13 +43,23 @@ class Component(object):
         self.notify = self.get_component_notify()
         self.strategy = self.get_component_deployment_strategy()
         self.defined_outputs = self.get_component_defined_outputs()
+        self.template_bucket = self.settings.get(':template-bucket')
 
     def get_component_settings(self, component_name):
         settings = self.config[':components'][':' + component_name][':settings']
-        if settings[':region'] != self.region or settings[':environment'] != self.environment:
+        if not matches_region(settings, self.region) or settings[':environment'] != self.environment:
             raise Exception("setting section of the config-file does not match environment or region")
         return settings
 
+    def get_stack_name_candidates(self):
+        original_stack_name = self.get_stack_name(self.get_component_settings(self.name))
+        return [original_stack_name, original_stack_name + '-B', original_stack_name + '-G']
+
+    def prefetch_stack_outputs(self):
+        # resolve the stacks referenced by inputs and our own B/G candidates in one parallel round
+        referenced_stack_names = [self.get_stack_name(self.get_component_settings(c)) for c in get_referenced_components(self.config, self.name)]
+        self.stack_outputs.prefetch(referenced_stack_names + self.get_stack_name_candidates())
+
     def get_component_inputs(self):
         def parse_input(key, value):
             if isinstance(value, dict) and ':component' in value and ':output-key' in value:
@@ -43,9 +78,10 @@ class Component(object):
                 return { 'ParameterKey': key[1:], 'ParameterValue': pval }
 
         inputs = self.config[':components'][':' + self.name][':inputs']
-        if inputs[':region'] != self.region or inputs[':environment'] != self.environment:
+        if not matches_region(inputs, self.region) or inputs[':environment'] != self.environment:
             raise Exception("inputs section of the config-file does not match environment or region")
-        ignored_inputs = set([':application', ':component', ':environment', ':region'])
+        self.prefetch_stack_outputs()
+        ignored_inputs = set([':application', ':component', ':environment', ':region', ':regions'])
         parsed_inputs = [parse_input(k, v) for k, v in inputs.iteritems() if k not in ignored_inputs]
         return parsed_inputs
 
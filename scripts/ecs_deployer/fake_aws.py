@@ -0,0 +1,834 @@
+from __future__ import print_function
+import collections
+import datetime
+import heapq
+import itertools
+import json
+import random
+import threading
+import time as _real_time
+from botocore.exceptions import ClientError
+from helper import *
+from template_diff import get_references
+
+# In-process stand-in for the CloudFormation, autoscaling, ELB, ELBv2, ECS and S3 calls made by
+# aws_helper.AWS, running on a simulated clock. Used by benchmark.py.
+#
+#   clock = SimulatedClock()
+#   backend = FakeBackend(clock)
+#   aws = AWS(region, session=FakeSession(backend))
+#
+# Simulated behaviour: stack creation/update/deletion times, resources created after the resources
+# they refer to, instance boot and load balancer health check times, target groups reporting
+# unused until a listener forwards to them, task rescheduling when instances are drained, per service API rate limits (ThrottlingException)
+# and per call latency. Fake clients emit the botocore events metrics and rate_limiter hook into.
+
+INSTANCE_TYPES = {
+    't2.medium': (2048, 3952),
+    'm4.large': (2048, 7986),
+    'm4.xlarge': (4096, 16048),
+    'm4.2xlarge': (8192, 32176),
+    'c4.xlarge': (4096, 7482),
+}
+
+RESERVED_PORTS = ['22', '2375', '2376', '51678', '51679']
+
+# seconds to create the resources that take a known time, the others take a random part of the stack creation time
+RESOURCE_CREATE_SECONDS = {
+    'AWS::AutoScaling::LaunchConfiguration': 5,
+    'AWS::ElasticLoadBalancingV2::TargetGroup': 10,
+    'AWS::ElasticLoadBalancingV2::Listener': 5
+}
+
+# Simulated time shared by all threads. time() includes the calling thread's pending API latency.
+# A sleeping thread only wakes up once the clock is advanced, which happens when no thread has
+# been active (called the backend, started or finished sleeping) for `quiescence` real seconds.
+class SimulatedClock(object):
+    def __init__(self, start=1500000000.0, quiescence=0.001):
+        self.now = start
+        self.started_at = start
+        self.quiescence = quiescence
+        self.cond = threading.Condition()
+        self.wakeups = []
+        self.activity = 0
+        self.stopped = False
+        self.local = threading.local()
+        self.coordinator = threading.Thread(target=self._run)
+        self.coordinator.daemon = True
+        self.coordinator.start()
+
+    def _debt(self):
+        return getattr(self.local, 'debt', 0.0)
+
+    def elapsed(self):
+        return self.now - self.started_at
+
+    def time(self):
+        return self.now + self._debt()
+
+    def touch(self):
+        with self.cond:
+            self.activity += 1
+
+    def charge(self, seconds):
+        # latency is accumulated and only slept off once it adds up, to keep real time low
+        self.local.debt = self._debt() + seconds
+        self.touch()
+        if self.local.debt >= 1:
+            self.sleep(0)
+
+    def sleep(self, seconds):
+        seconds = max(seconds, 0) + self._debt()
+        self.local.debt = 0.0
+        with self.cond:
+            target = self.now + seconds
+            heapq.heappush(self.wakeups, target)
+            self.activity += 1
+            while self.now < target:
+                self.cond.wait()
+            self.wakeups.remove(target)
+            heapq.heapify(self.wakeups)
+            self.activity += 1
+
+    def stop(self):
+        self.stopped = True
+        self.coordinator.join()
+
+    def _run(self):
+        while not self.stopped:
+            with self.cond:
+                activity = self.activity
+            _real_time.sleep(self.quiescence)
+            with self.cond:
+                if self.activity == activity and self.wakeups:
+                    self.now = max(self.now, self.wakeups[0])
+                    self.cond.notify_all()
+
+def get_resource_dependencies(template):
+    # {logical id: the logical ids of the resources it refers to}
+    resources = template.get('Resources', {})
+    return {logical_id: get_references(resource) & set(resources) - {logical_id} for logical_id, resource in resources.iteritems()}
+
+class FakeError(Exception):
+    def __init__(self, code, message):
+        super(FakeError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+class FakeBackend(object):
+    def __init__(self, clock, seed=0,
+                 stack_create_seconds=240, stack_update_seconds=120, stack_delete_seconds=180, asg_create_seconds=60, load_balancer_create_seconds=360,
+                 instance_boot_seconds=120, health_check_seconds=30, task_start_seconds=(20, 60), task_stop_seconds=(5, 30),
+                 api_latency=0.05, api_rates=None):
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.stack_create_seconds = stack_create_seconds
+        self.stack_update_seconds = stack_update_seconds
+        self.stack_delete_seconds = stack_delete_seconds
+        self.asg_create_seconds = asg_create_seconds
+        self.load_balancer_create_seconds = load_balancer_create_seconds
+        self.instance_boot_seconds = instance_boot_seconds
+        self.health_check_seconds = health_check_seconds
+        self.task_start_seconds = task_start_seconds
+        self.task_stop_seconds = task_stop_seconds
+        self.api_latency = api_latency
+        # (calls per second, burst) per service
+        self.api_rates = api_rates or {'ecs': (20, 50), 'autoscaling': (10, 40), 'cloudformation': (5, 20), 'elb': (10, 40), 'elbv2': (10, 40), 's3': (100, 300)}
+        self.buckets = {}
+        self.lock = threading.RLock()
+        self.scheduled = []
+        self.ids = itertools.count(1)
+        self.stacks = {}
+        self.asgs = {}
+        # load balancer name or target group arn: {instance id: in service}
+        self.load_balancers = collections.defaultdict(dict)
+        # target group arn: whether a listener forwards to it. Target groups created outside of the stacks are always in use
+        self.target_groups = {}
+        # (bucket, key): content
+        self.objects = {}
+        self.clusters = {}
+        self.task_definitions = {}
+        self.listings = {}
+
+    def next_id(self):
+        return next(self.ids)
+
+    # -- simulation ----------------------------------------------------------------------
+
+    def schedule(self, at, func):
+        heapq.heappush(self.scheduled, (at, self.next_id(), func))
+
+    def advance(self, now):
+        while self.scheduled and self.scheduled[0][0] <= now:
+            at, _, func = heapq.heappop(self.scheduled)
+            func(at)
+
+    def is_throttled(self, service, now):
+        rate, burst = self.api_rates.get(service, (None, None))
+        if rate is None:
+            return False
+        tokens, updated_at = self.buckets.get(service, (burst, now))
+        tokens = min(tokens + (now - updated_at) * rate, burst)
+        if tokens < 1:
+            self.buckets[service] = (tokens, now)
+            return True
+        self.buckets[service] = (tokens - 1, now)
+        return False
+
+    def uniform(self, bounds):
+        return self.random.uniform(*bounds)
+
+    # -- setup ---------------------------------------------------------------------------
+
+    def get_cluster(self, cluster_name):
+        if cluster_name not in self.clusters:
+            self.clusters[cluster_name] = {'instances': collections.OrderedDict(), 'tasks': collections.OrderedDict(), 'stopped_tasks': {}, 'services': collections.OrderedDict(), 'cursor': 0}
+        return self.clusters[cluster_name]
+
+    def register_task_definition(self, family, cpu, memory, host_port=None):
+        arn = 'arn:aws:ecs:fake:000000000000:task-definition/{}:1'.format(family)
+        self.task_definitions[arn] = {
+            'taskDefinitionArn': arn,
+            'family': family,
+            'containerDefinitions': [{
+                'name': family,
+                'image': '{}:latest'.format(family),
+                'cpu': cpu,
+                'memory': memory,
+                'portMappings': [{'containerPort': 8080, 'hostPort': host_port or 0, 'protocol': 'tcp'}]
+            }]
+        }
+        return arn
+
+    def create_service(self, cluster_name, service_name, task_definition_arn, desired_count):
+        cluster = self.get_cluster(cluster_name)
+        service = {
+            'serviceArn': 'arn:aws:ecs:fake:000000000000:service/{}'.format(service_name),
+            'serviceName': service_name,
+            'clusterArn': 'arn:aws:ecs:fake:000000000000:cluster/{}'.format(cluster_name),
+            'taskDefinition': task_definition_arn,
+            'desiredCount': desired_count,
+            'schedulingStrategy': 'REPLICA',
+            'events': [],
+            # keys starting with _ are not returned by describe_services
+            '_deployment_id': 'ecs-svc/{}'.format(self.next_id()),
+            '_previous_deployment_id': None,
+            '_old_tasks': set()
+        }
+        cluster['services'][service_name] = service
+        for _ in xrange(desired_count):
+            if not self.start_task(cluster_name, service_name, self.clock.time()):
+                raise Exception('Not enough capacity in cluster {} for service {}'.format(cluster_name, service_name))
+        return service
+
+    def create_stack_now(self, stack_name, template, parameters):
+        # create a stack instantly, e.g. the existing stack of a benchmark scenario
+        stack = self.new_stack(stack_name, template, parameters, [], self.clock.time())
+        dependencies = get_resource_dependencies(stack['Template'])
+        created = set()
+        def create(logical_id):
+            if logical_id not in created:
+                for dependency in sorted(dependencies[logical_id]):
+                    create(dependency)
+                self.create_resource(stack, logical_id, self.clock.time(), instances_ready=True)
+                created.add(logical_id)
+        for logical_id in sorted(dependencies):
+            create(logical_id)
+        self.complete_stack(stack, 'CREATE_COMPLETE', self.clock.time())
+        return stack
+
+    # -- cloudformation ------------------------------------------------------------------
+
+    def new_stack(self, stack_name, template, parameters, tags, now):
+        if stack_name in self.stacks:
+            raise FakeError('AlreadyExistsException', 'Stack [{}] already exists'.format(stack_name))
+        stack = {
+            'StackName': stack_name,
+            'StackId': 'arn:aws:cloudformation:fake:000000000000:stack/{}/{}'.format(stack_name, self.next_id()),
+            'StackStatus': 'CREATE_IN_PROGRESS',
+            'CreationTime': datetime.datetime.utcfromtimestamp(now),
+            'Template': json.loads(template) if isinstance(template, basestring) else template,
+            'Parameters': [{'ParameterKey': k, 'ParameterValue': v} for k, v in sorted(parameters.iteritems())],
+            'Tags': tags,
+            'Outputs': [],
+            'Events': [],
+            'PhysicalIds': {}
+        }
+        self.stacks[stack_name] = stack
+        self.add_stack_event(stack, stack_name, 'AWS::CloudFormation::Stack', 'CREATE_IN_PROGRESS', stack['StackId'], now)
+        return stack
+
+    def add_stack_event(self, stack, logical_id, resource_type, status, physical_id, at):
+        stack['Events'].append({
+            'EventId': str(self.next_id()),
+            'StackId': stack['StackId'],
+            'StackName': stack['StackName'],
+            'LogicalResourceId': logical_id,
+            'PhysicalResourceId': physical_id or '',
+            'ResourceType': resource_type,
+            'ResourceStatus': status,
+            'Timestamp': at
+        })
+
+    def get_parameters(self, stack):
+        return {p['ParameterKey']: p['ParameterValue'] for p in stack['Parameters']}
+
+    def resolve(self, stack, value):
+        if isinstance(value, dict) and 'Ref' in value:
+            ref = value['Ref']
+            return stack['PhysicalIds'].get(ref, self.get_parameters(stack).get(ref))
+        return value
+
+    def create_resource(self, stack, logical_id, now, instances_ready=False):
+        resource = stack['Template']['Resources'][logical_id]
+        physical_id = '{}-{}-{}'.format(stack['StackName'], logical_id, self.next_id())
+        if resource.get('Type') == 'AWS::AutoScaling::AutoScalingGroup':
+            properties = resource.get('Properties', {})
+            metadata = resource.get('Metadata', {})
+            self.asgs[physical_id] = {
+                'AutoScalingGroupName': physical_id,
+                'MinSize': int(self.resolve(stack, properties.get('MinSize', 0))),
+                'MaxSize': int(self.resolve(stack, properties.get('MaxSize', 0))),
+                'DesiredCapacity': 0,
+                'Instances': [],
+                'LoadBalancerNames': [self.resolve(stack, name) for name in properties.get('LoadBalancerNames', [])],
+                'TargetGroupARNs': [self.resolve(stack, arn) for arn in properties.get('TargetGroupARNs', [])],
+                'ClusterName': self.resolve(stack, metadata.get('ECSCluster')),
+                'InstanceType': self.resolve(stack, metadata.get('InstanceType', 'm4.large'))
+            }
+            desired_capacity = int(self.resolve(stack, properties.get('DesiredCapacity', properties.get('MinSize', 0))))
+            self.scale_asg(physical_id, desired_capacity, now, instances_ready=instances_ready)
+        elif resource.get('Type') == 'AWS::ElasticLoadBalancingV2::TargetGroup':
+            self.target_groups[physical_id] = False
+        elif resource.get('Type') == 'AWS::ElasticLoadBalancingV2::Listener':
+            for action in resource.get('Properties', {}).get('DefaultActions', []):
+                self.use_target_group(self.resolve(stack, action.get('TargetGroupArn')), now, instances_ready=instances_ready)
+        stack['PhysicalIds'][logical_id] = physical_id
+        self.add_stack_event(stack, logical_id, resource.get('Type'), 'CREATE_COMPLETE', physical_id, now)
+
+    def use_target_group(self, target_group_arn, now, instances_ready=False):
+        # the health checks of the registered instances only start once a listener forwards to the target group
+        self.target_groups[target_group_arn] = True
+        for asg in self.asgs.values():
+            if target_group_arn in asg['TargetGroupARNs']:
+                for instance in asg['Instances']:
+                    if instance['InstanceId'] in self.load_balancers[target_group_arn] and not instances_ready:
+                        self.load_balancers[target_group_arn][instance['InstanceId']] = False
+                        self.schedule(now + self.health_check_seconds * self.random.uniform(0.8, 1.2), lambda at, asg=asg, instance=instance: self.pass_health_checks(asg, instance, at))
+
+    def get_create_seconds(self, resource):
+        if resource.get('Type') == 'AWS::AutoScaling::AutoScalingGroup':
+            return self.asg_create_seconds
+        if resource.get('Type') == 'AWS::ElasticLoadBalancingV2::LoadBalancer':
+            return self.load_balancer_create_seconds
+        if resource.get('Type') in RESOURCE_CREATE_SECONDS:
+            return RESOURCE_CREATE_SECONDS[resource['Type']]
+        return self.random.uniform(0, self.stack_create_seconds)
+
+    def complete_stack(self, stack, status, now):
+        stack['StackStatus'] = status
+        stack['Outputs'] = [{'OutputKey': k, 'OutputValue': self.resolve(stack, v.get('Value'))} for k, v in sorted(stack['Template'].get('Outputs', {}).iteritems())]
+        self.add_stack_event(stack, stack['StackName'], 'AWS::CloudFormation::Stack', status, stack['StackId'], now)
+
+    def find_stack(self, stack_name):
+        stack = next((s for s in self.stacks.itervalues() if stack_name in [s['StackName'], s['StackId']]), None)
+        if stack is None:
+            raise FakeError('ValidationError', 'Stack with id {} does not exist'.format(stack_name))
+        return stack
+
+    def describe_stack(self, stack):
+        return {k: stack[k] for k in ['StackName', 'StackId', 'StackStatus', 'CreationTime', 'LastUpdatedTime', 'Parameters', 'Tags', 'Outputs'] if k in stack}
+
+    def cloudformation_describe_stacks(self, now, StackName=None, NextToken=None):
+        stacks = [self.find_stack(StackName)] if StackName else self.stacks.values()
+        return {'Stacks': [self.describe_stack(s) for s in stacks]}
+
+    def cloudformation_describe_stack_events(self, now, StackName, NextToken=None):
+        events = list(reversed(self.find_stack(StackName)['Events']))
+        return self.page(events, NextToken, 100, 'StackEvents', 'NextToken')
+
+    def cloudformation_get_template(self, now, StackName):
+        return {'TemplateBody': self.find_stack(StackName)['Template']}
+
+    def cloudformation_get_template_summary(self, now, StackName):
+        template = self.find_stack(StackName)['Template']
+        return {'Parameters': [{'ParameterKey': k, 'NoEcho': str(v.get('NoEcho', 'false')).lower() == 'true'} for k, v in sorted(template.get('Parameters', {}).iteritems())]}
+
+    def get_template_body(self, TemplateBody=None, TemplateURL=None):
+        if TemplateURL is None:
+            return TemplateBody
+        # https://bucket.s3.region.amazonaws.com/key
+        bucket, _, key = TemplateURL[len('https://'):].partition('/')
+        content = self.objects.get((bucket.split('.s3.')[0], key))
+        if content is None:
+            raise FakeError('ValidationError', 'TemplateURL must be a supported URL.')
+        return content
+
+    def cloudformation_create_stack(self, now, StackName, TemplateBody=None, TemplateURL=None, Parameters=None, Tags=None, **kwargs):
+        parameters = {p['ParameterKey']: p['ParameterValue'] for p in (Parameters or [])}
+        stack = self.new_stack(StackName, self.get_template_body(TemplateBody, TemplateURL), parameters, Tags or [], now)
+
+        # a resource is created once the resources it refers to are, the stack once all of them are
+        resources = stack['Template'].get('Resources', {})
+        dependencies = get_resource_dependencies(stack['Template'])
+        created_at = {}
+        def get_created_at(logical_id):
+            if logical_id not in created_at:
+                started_at = max([now] + [get_created_at(dependency) for dependency in sorted(dependencies[logical_id])])
+                created_at[logical_id] = started_at + self.get_create_seconds(resources[logical_id])
+            return created_at[logical_id]
+
+        for logical_id in sorted(resources):
+            self.schedule(get_created_at(logical_id), lambda at, logical_id=logical_id: self.create_resource(stack, logical_id, at))
+        self.schedule(max([now + self.stack_create_seconds] + created_at.values()), lambda at: self.complete_stack(stack, 'CREATE_COMPLETE', at))
+        return {'StackId': stack['StackId']}
+
+    def cloudformation_update_stack(self, now, StackName, TemplateBody=None, TemplateURL=None, Parameters=None, Tags=None, **kwargs):
+        template = self.get_template_body(TemplateBody, TemplateURL)
+        stack = self.find_stack(StackName)
+        stack['StackStatus'] = 'UPDATE_IN_PROGRESS'
+        stack['LastUpdatedTime'] = datetime.datetime.utcfromtimestamp(now)
+        stack['Template'] = json.loads(template)
+        stack['Parameters'] = Parameters or []
+        stack['Tags'] = Tags or []
+
+        def complete(at):
+            for logical_id, physical_id in stack['PhysicalIds'].iteritems():
+                if physical_id in self.asgs:
+                    properties = stack['Template']['Resources'][logical_id].get('Properties', {})
+                    asg = self.asgs[physical_id]
+                    asg['MinSize'] = int(self.resolve(stack, properties.get('MinSize', asg['MinSize'])))
+                    asg['MaxSize'] = int(self.resolve(stack, properties.get('MaxSize', asg['MaxSize'])))
+                    desired_capacity = min(max(asg['DesiredCapacity'], asg['MinSize']), asg['MaxSize'])
+                    self.scale_asg(physical_id, desired_capacity, at)
+            self.complete_stack(stack, 'UPDATE_COMPLETE', at)
+
+        self.schedule(now + self.stack_update_seconds, complete)
+        return {'StackId': stack['StackId']}
+
+    def cloudformation_delete_stack(self, now, StackName):
+        stack = self.find_stack(StackName)
+        stack['StackStatus'] = 'DELETE_IN_PROGRESS'
+
+        def complete(at):
+            for physical_id in stack['PhysicalIds'].itervalues():
+                if physical_id in self.asgs:
+                    self.scale_asg(physical_id, 0, at)
+                    del self.asgs[physical_id]
+            del self.stacks[stack['StackName']]
+
+        self.schedule(now + self.stack_delete_seconds, complete)
+        return {}
+
+    # -- autoscaling ---------------------------------------------------------------------
+
+    def scale_asg(self, asg_name, desired_capacity, now, instances_ready=False):
+        asg = self.asgs[asg_name]
+        asg['DesiredCapacity'] = desired_capacity
+        while len(asg['Instances']) < desired_capacity:
+            instance = {'InstanceId': 'i-{:08x}'.format(self.next_id()), 'HealthStatus': 'Unhealthy', 'LifecycleState': 'Pending'}
+            asg['Instances'].append(instance)
+            if instances_ready:
+                self.boot_instance(asg, instance, now)
+                self.pass_health_checks(asg, instance, now)
+            else:
+                self.schedule(now + self.instance_boot_seconds * self.random.uniform(0.8, 1.2), lambda at, instance=instance: self.boot_instance(asg, instance, at))
+        while len(asg['Instances']) > desired_capacity:
+            self.terminate_instance(asg, asg['Instances'].pop(), now)
+
+    def boot_instance(self, asg, instance, now):
+        if instance not in asg['Instances']:
+            return
+        instance['HealthStatus'] = 'Healthy'
+        instance['LifecycleState'] = 'InService'
+        for name in asg['LoadBalancerNames'] + asg['TargetGroupARNs']:
+            self.load_balancers[name][instance['InstanceId']] = False
+        self.schedule(now + self.health_check_seconds * self.random.uniform(0.8, 1.2), lambda at: self.pass_health_checks(asg, instance, at))
+        if asg['ClusterName']:
+            cpu, memory = INSTANCE_TYPES[asg['InstanceType']]
+            cluster = self.get_cluster(asg['ClusterName'])
+            arn = 'arn:aws:ecs:fake:000000000000:container-instance/{}'.format(self.next_id())
+            cluster['instances'][arn] = {
+                'containerInstanceArn': arn,
+                'ec2InstanceId': instance['InstanceId'],
+                'status': 'ACTIVE',
+                'registered': {'cpu': cpu, 'memory': memory, 'ports': set(RESERVED_PORTS)},
+                'remaining': {'cpu': cpu, 'memory': memory, 'ports': set(RESERVED_PORTS)},
+                'tasks': set(),
+                'attributes': {}
+            }
+
+    def pass_health_checks(self, asg, instance, now):
+        for name in asg['LoadBalancerNames'] + asg['TargetGroupARNs']:
+            if instance['InstanceId'] in self.load_balancers[name]:
+                self.load_balancers[name][instance['InstanceId']] = True
+
+    def terminate_instance(self, asg, instance, now):
+        for name in asg['LoadBalancerNames'] + asg['TargetGroupARNs']:
+            self.load_balancers[name].pop(instance['InstanceId'], None)
+        cluster = self.clusters.get(asg['ClusterName'])
+        if cluster is None:
+            return
+        for arn, container_instance in cluster['instances'].items():
+            if container_instance['ec2InstanceId'] == instance['InstanceId']:
+                for task_arn in list(container_instance['tasks']):
+                    self.stop_task(asg['ClusterName'], task_arn, now)
+                del cluster['instances'][arn]
+
+    def autoscaling_describe_auto_scaling_groups(self, now, AutoScalingGroupNames, NextToken=None):
+        keys = ['AutoScalingGroupName', 'MinSize', 'MaxSize', 'DesiredCapacity', 'LoadBalancerNames', 'TargetGroupARNs']
+        return {'AutoScalingGroups': [dict({k: self.asgs[n][k] for k in keys}, Instances=[dict(i) for i in self.asgs[n]['Instances']])
+                                      for n in AutoScalingGroupNames if n in self.asgs]}
+
+    def autoscaling_set_desired_capacity(self, now, AutoScalingGroupName, DesiredCapacity, **kwargs):
+        asg = self.asgs[AutoScalingGroupName]
+        if DesiredCapacity > asg['MaxSize'] or DesiredCapacity < asg['MinSize']:
+            raise FakeError('ValidationError', 'New SetDesiredCapacity value {} is outside of the min/max bounds'.format(DesiredCapacity))
+        self.scale_asg(AutoScalingGroupName, DesiredCapacity, now)
+        return {}
+
+    # -- elb -----------------------------------------------------------------------------
+
+    def elb_describe_instance_health(self, now, LoadBalancerName):
+        return {'InstanceStates': [{'InstanceId': instance_id, 'State': 'InService' if in_service else 'OutOfService'}
+                                   for instance_id, in_service in sorted(self.load_balancers[LoadBalancerName].iteritems())]}
+
+    def elbv2_describe_target_health(self, now, TargetGroupArn):
+        def get_state(in_service):
+            if not self.target_groups.get(TargetGroupArn, True):
+                return 'unused'
+            return 'healthy' if in_service else 'initial'
+        return {'TargetHealthDescriptions': [{'Target': {'Id': instance_id, 'Port': 80}, 'TargetHealth': {'State': get_state(in_service)}}
+                                             for instance_id, in_service in sorted(self.load_balancers[TargetGroupArn].iteritems())]}
+
+    # -- s3 ------------------------------------------------------------------------------
+
+    def s3_head_object(self, now, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeError('404', 'Not Found')
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def s3_put_object(self, now, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body.read() if hasattr(Body, 'read') else Body
+        return {}
+
+    # -- ecs -----------------------------------------------------------------------------
+
+    def fits(self, container_instance, task_definition):
+        container = task_definition['containerDefinitions'][0]
+        ports = {str(m['hostPort']) for m in container['portMappings'] if m['hostPort']}
+        remaining = container_instance['remaining']
+        return remaining['cpu'] >= container['cpu'] and remaining['memory'] >= container['memory'] and not (remaining['ports'] & ports)
+
+    def start_task(self, cluster_name, service_name, now):
+        cluster = self.get_cluster(cluster_name)
+        service = cluster['services'][service_name]
+        task_definition = self.task_definitions[service['taskDefinition']]
+        candidates = [i for i in cluster['instances'].itervalues() if i['status'] == 'ACTIVE']
+        if len(candidates) == 0:
+            return None
+
+        # round robin over the active instances, a rough approximation of ECS spread placement
+        for offset in xrange(len(candidates)):
+            container_instance = candidates[(cluster['cursor'] + offset) % len(candidates)]
+            if self.fits(container_instance, task_definition):
+                cluster['cursor'] = (cluster['cursor'] + offset + 1) % len(candidates)
+                break
+        else:
+            return None
+
+        container = task_definition['containerDefinitions'][0]
+        ports = {str(m['hostPort']) for m in container['portMappings'] if m['hostPort']}
+        container_instance['remaining']['cpu'] -= container['cpu']
+        container_instance['remaining']['memory'] -= container['memory']
+        container_instance['remaining']['ports'] |= ports
+
+        arn = 'arn:aws:ecs:fake:000000000000:task/{}'.format(self.next_id())
+        cluster['tasks'][arn] = {
+            'taskArn': arn,
+            'clusterArn': service['clusterArn'],
+            'containerInstanceArn': container_instance['containerInstanceArn'],
+            'taskDefinitionArn': service['taskDefinition'],
+            'group': 'service:' + service_name,
+            'lastStatus': 'RUNNING',
+            'desiredStatus': 'RUNNING',
+            'startedBy': 'ecs-svc/' + service_name
+        }
+        container_instance['tasks'].add(arn)
+        return arn
+
+    def stop_task(self, cluster_name, task_arn, now):
+        cluster = self.get_cluster(cluster_name)
+        task = cluster['tasks'].pop(task_arn, None)
+        if task is None:
+            return
+        # like ECS, stopped tasks can still be described for a while
+        cluster['stopped_tasks'][task_arn] = dict(task, lastStatus='STOPPED', desiredStatus='STOPPED')
+        container_instance = cluster['instances'].get(task['containerInstanceArn'])
+        if container_instance is not None:
+            container = self.task_definitions[task['taskDefinitionArn']]['containerDefinitions'][0]
+            container_instance['remaining']['cpu'] += container['cpu']
+            container_instance['remaining']['memory'] += container['memory']
+            container_instance['remaining']['ports'] -= {str(m['hostPort']) for m in container['portMappings'] if m['hostPort']}
+            container_instance['tasks'].discard(task_arn)
+
+    def replace_task(self, cluster_name, task_arn, now):
+        # the replacement starts first, the drained task is stopped once it is running
+        task = self.get_cluster(cluster_name)['tasks'].get(task_arn)
+        if task is None:
+            return
+        if self.start_task(cluster_name, task['group'][len('service:'):], now) is None:
+            self.schedule(now + 30, lambda at: self.replace_task(cluster_name, task_arn, at))
+            return
+        self.schedule(now + self.uniform(self.task_stop_seconds), lambda at: self.stop_task(cluster_name, task_arn, at))
+
+    def describe_container_instance(self, container_instance):
+        def resources(r):
+            return [{'name': 'CPU', 'type': 'INTEGER', 'integerValue': r['cpu']},
+                    {'name': 'MEMORY', 'type': 'INTEGER', 'integerValue': r['memory']},
+                    {'name': 'PORTS', 'type': 'STRINGSET', 'stringSetValue': sorted(r['ports'])},
+                    {'name': 'PORTS_UDP', 'type': 'STRINGSET', 'stringSetValue': []}]
+        return {
+            'containerInstanceArn': container_instance['containerInstanceArn'],
+            'ec2InstanceId': container_instance['ec2InstanceId'],
+            'status': container_instance['status'],
+            'agentConnected': True,
+            'runningTasksCount': len(container_instance['tasks']),
+            'pendingTasksCount': 0,
+            'registeredResources': resources(container_instance['registered']),
+            'remainingResources': resources(container_instance['remaining'])
+        }
+
+    def check_batch(self, items, limit, name):
+        if len(items) > limit:
+            raise FakeError('InvalidParameterException', '{} can have at most {} items.'.format(name, limit))
+
+    def ecs_list_container_instances(self, now, cluster, status=None, nextToken=None):
+        arns = self.listing(('list_container_instances', cluster, status), nextToken,
+                            lambda: [arn for arn, i in self.get_cluster(cluster)['instances'].iteritems() if status is None or i['status'] == status])
+        return self.page(arns, nextToken, 100, 'containerInstanceArns', 'nextToken')
+
+    def ecs_describe_container_instances(self, now, cluster, containerInstances):
+        self.check_batch(containerInstances, 100, 'containerInstances')
+        instances = self.get_cluster(cluster)['instances']
+        return {'containerInstances': [self.describe_container_instance(instances[arn]) for arn in containerInstances if arn in instances],
+                'failures': [{'arn': arn, 'reason': 'MISSING'} for arn in containerInstances if arn not in instances]}
+
+    def ecs_update_container_instances_state(self, now, cluster, containerInstances, status):
+        self.check_batch(containerInstances, 10, 'containerInstances')
+        instances = self.get_cluster(cluster)['instances']
+        for arn in containerInstances:
+            instances[arn]['status'] = status
+            if status == 'DRAINING':
+                for task_arn in sorted(instances[arn]['tasks']):
+                    self.schedule(now + self.uniform(self.task_start_seconds), lambda at, task_arn=task_arn: self.replace_task(cluster, task_arn, at))
+        return {'containerInstances': [self.describe_container_instance(instances[arn]) for arn in containerInstances], 'failures': []}
+
+    def ecs_put_attributes(self, now, cluster, attributes):
+        self.check_batch(attributes, 10, 'attributes')
+        instances = self.get_cluster(cluster)['instances']
+        for attribute in attributes:
+            instances[attribute['targetId']]['attributes'][attribute['name']] = attribute.get('value')
+        return {'attributes': attributes}
+
+    def ecs_list_tasks(self, now, cluster, containerInstance=None, serviceName=None, desiredStatus='RUNNING', nextToken=None):
+        def list_tasks():
+            return [t['taskArn'] for t in self.get_cluster(cluster)['tasks'].itervalues()
+                    if t['desiredStatus'] == desiredStatus
+                    and (containerInstance is None or t['containerInstanceArn'] == containerInstance)
+                    and (serviceName is None or t['group'] == 'service:' + serviceName.split('/')[-1])]
+        arns = self.listing(('list_tasks', cluster, containerInstance, serviceName, desiredStatus), nextToken, list_tasks)
+        return self.page(arns, nextToken, 100, 'taskArns', 'nextToken')
+
+    def ecs_describe_tasks(self, now, cluster, tasks):
+        self.check_batch(tasks, 100, 'tasks')
+        c = self.get_cluster(cluster)
+        all_tasks = dict(c['stopped_tasks'], **c['tasks'])
+        return {'tasks': [dict(all_tasks[arn]) for arn in tasks if arn in all_tasks],
+                'failures': [{'arn': arn, 'reason': 'MISSING'} for arn in tasks if arn not in all_tasks]}
+
+    def ecs_list_services(self, now, cluster, nextToken=None):
+        arns = [s['serviceArn'] for s in self.get_cluster(cluster)['services'].itervalues()]
+        return self.page(arns, nextToken, 10, 'serviceArns', 'nextToken')
+
+    def ecs_describe_services(self, now, cluster, services):
+        self.check_batch(services, 10, 'services')
+        c = self.get_cluster(cluster)
+        by_arn = {s['serviceArn']: s for s in c['services'].itervalues()}
+        by_arn.update(c['services'])
+        return {'services': [self.describe_service(c, by_arn[arn]) for arn in services if arn in by_arn],
+                'failures': [{'arn': arn, 'reason': 'MISSING'} for arn in services if arn not in by_arn]}
+
+    def describe_service(self, cluster, service):
+        task_arns = [arn for arn, t in cluster['tasks'].iteritems() if t['group'] == 'service:' + service['serviceName']]
+        old_count = sum(1 for arn in task_arns if arn in service['_old_tasks'])
+        new_count = len(task_arns) - old_count
+        deployments = [{'id': service['_deployment_id'], 'status': 'PRIMARY', 'taskDefinition': service['taskDefinition'], 'desiredCount': service['desiredCount'], 'runningCount': new_count,
+                        'rolloutState': 'COMPLETED' if old_count == 0 and new_count >= service['desiredCount'] else 'IN_PROGRESS'}]
+        if old_count > 0:
+            deployments.append({'id': service['_previous_deployment_id'], 'status': 'ACTIVE', 'taskDefinition': service['taskDefinition'], 'desiredCount': 0, 'runningCount': old_count})
+        return dict({k: v for k, v in service.iteritems() if not k.startswith('_')}, runningCount=len(task_arns), pendingCount=0, deployments=deployments)
+
+    def ecs_update_service(self, now, cluster, service, forceNewDeployment=False, **kwargs):
+        # a forced deployment replaces every task: the new task starts, then the old one stops
+        c = self.get_cluster(cluster)
+        s = c['services'].get(service) or one(s for s in c['services'].itervalues() if s['serviceArn'] == service)
+        if forceNewDeployment:
+            s['_previous_deployment_id'] = s['_deployment_id']
+            s['_deployment_id'] = 'ecs-svc/{}'.format(self.next_id())
+            s['_old_tasks'] = {arn for arn, t in c['tasks'].iteritems() if t['group'] == 'service:' + s['serviceName']}
+            for arn in sorted(s['_old_tasks']):
+                self.schedule(now + self.uniform(self.task_start_seconds), lambda at, arn=arn: self.replace_task(cluster, arn, at))
+        return {'service': self.describe_service(c, s)}
+
+    def ecs_describe_task_definition(self, now, taskDefinition):
+        return {'taskDefinition': self.task_definitions[taskDefinition]}
+
+    # -- plumbing ------------------------------------------------------------------------
+
+    def listing(self, key, token, list_items):
+        # the listing is taken on the first page, following pages are served from it
+        if token is None or key not in self.listings:
+            self.listings[key] = list_items()
+        return self.listings[key]
+
+    def page(self, items, token, page_size, key, token_key):
+        start = int(token or 0)
+        response = {key: items[start:start + page_size]}
+        if start + page_size < len(items):
+            response[token_key] = str(start + page_size)
+        return response
+
+    def call(self, service, method, params):
+        # returns (status code, parsed response)
+        with self.lock:
+            now = self.clock.time()
+            self.advance(now)
+            if self.is_throttled(service, now):
+                return 400, {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}
+            handler = getattr(self, '{}_{}'.format(service, method), None)
+            if handler is None:
+                raise NotImplementedError('{}.{} is not simulated'.format(service, method))
+            try:
+                return 200, handler(now, **params)
+            except FakeError as e:
+                return 400, {'Error': {'Code': e.code, 'Message': e.message}}
+
+# -- fake boto3 objects ------------------------------------------------------------------
+
+class FakeEvents(object):
+    def __init__(self):
+        self.handlers = collections.defaultdict(list)
+
+    def register(self, event_name, handler):
+        self.handlers[event_name].append(handler)
+
+    def register_first(self, event_name, handler):
+        self.handlers[event_name].insert(0, handler)
+
+    def emit(self, event_name, **kwargs):
+        for handler in list(self.handlers[event_name]):
+            handler(event_name=event_name, **kwargs)
+
+class FakeObject(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def to_operation_name(method):
+    return ''.join(word.capitalize() for word in method.split('_'))
+
+class FakePaginator(object):
+    def __init__(self, client, method):
+        self.client = client
+        self.method = method
+
+    def paginate(self, **params):
+        token_key = 'NextToken' if self.client.service_name == 'cloudformation' else 'nextToken'
+        while True:
+            page = getattr(self.client, self.method)(**params)
+            yield page
+            if token_key not in page:
+                return
+            params = dict(params, **{token_key: page[token_key]})
+
+class FakeWaiter(object):
+    # mirrors the CloudFormation waiters used by aws_helper: 30s delay, 120 attempts
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def wait(self, StackName):
+        success, failures = {
+            'stack_create_complete': ('CREATE_COMPLETE', ['CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_COMPLETE']),
+            'stack_update_complete': ('UPDATE_COMPLETE', ['UPDATE_FAILED', 'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED']),
+            'stack_delete_complete': ('DELETE_COMPLETE', ['DELETE_FAILED'])
+        }[self.name]
+        for _ in xrange(120):
+            try:
+                status = one(self.client.describe_stacks(StackName=StackName)['Stacks'])['StackStatus']
+            except ClientError as e:
+                if self.name == 'stack_delete_complete' and 'does not exist' in e.response['Error']['Message']:
+                    return
+                raise
+            if status == success:
+                return
+            if status in failures:
+                raise Exception('Waiter {} failed: stack {} is in {} state'.format(self.name, StackName, status))
+            self.client.backend.clock.sleep(30)
+        raise Exception('Waiter {} failed: max attempts exceeded'.format(self.name))
+
+class FakeClient(object):
+    def __init__(self, backend, service_name, region_name, config=None):
+        self.backend = backend
+        self.service_name = service_name
+        self.max_retries = (config.retries or {}).get('max_attempts', 4) if config is not None and config.retries else 4
+        self.meta = FakeObject(events=FakeEvents(), region_name=region_name, service_model=FakeObject(service_name=service_name))
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda **params: self._call(method, params)
+
+    def get_paginator(self, method):
+        return FakePaginator(self, method)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        # boto3's managed transfer, a single put_object is enough for the simulation
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read(), **(ExtraArgs or {}))
+
+    def get_waiter(self, name):
+        return FakeWaiter(self, name)
+
+    def _call(self, method, params):
+        clock = self.backend.clock
+        model = FakeObject(name=to_operation_name(method), service_model=self.meta.service_model)
+        context = {}
+        events = self.meta.events
+        events.emit('before-call', model=model, params=params, request_signer=None, context=context)
+
+        attempts = 0
+        while True:
+            attempts += 1
+            events.emit('before-send', request=None)
+            clock.charge(self.backend.api_latency)
+            status_code, parsed = self.backend.call(self.service_name, method, params)
+            response = (FakeObject(status_code=status_code), parsed)
+            events.emit('needs-retry', response=response, endpoint=None, operation=model, attempts=attempts, caught_exception=None, request_dict=params)
+            throttled = parsed.get('Error', {}).get('Code') == 'ThrottlingException'
+            if not throttled or attempts > self.max_retries:
+                break
+            # botocore's legacy retry policy: random base, doubling every attempt
+            clock.sleep(self.backend.random.random() * 2 ** (attempts - 1))
+
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': status_code, 'RetryAttempts': attempts - 1}
+        events.emit('after-call', http_response=response[0], parsed=parsed, model=model, context=context)
+        if 'Error' in parsed:
+            raise ClientError(parsed, model.name)
+        return parsed
+
+class FakeSession(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def client(self, service_name, region_name=None, config=None):
+        return FakeClient(self.backend, service_name, region_name, config)
@@ -2,15 +2,48 @@ from __future__ import print_function
 import __main__
 import datetime
 import itertools
+import multiprocessing.pool
 import os
+import Queue
+import random
+import threading
 import time
 import sys
+import traceback
 
 SCRIPT_NAME = os.path.basename(__main__.__file__)
 
+# shared by the server and the --server help of ecs_deployer, which only imports the server when it is used
+DEFAULT_SERVER_ADDRESS = 'unix:' + os.path.expanduser('~/.ecs_deployer.sock')
+SERVER_TOKEN_VARIABLE = 'ECS_DEPLOYER_SERVER_TOKEN'
+
+_log_lock = threading.Lock()
+_log_context = threading.local()
+
+def set_log_prefix(prefix):
+    _log_context.prefix = prefix
+
+def get_log_prefix():
+    return getattr(_log_context, 'prefix', None)
+
+def set_log_handler(handler):
+    # handler(line) receives every line logged by this thread, besides stdout
+    _log_context.handler = handler
+
+def get_log_handler():
+    return getattr(_log_context, 'handler', None)
+
 def log(message, level='INFO'):
-    print('{} [{}] ({}) {}'.format(datetime.datetime.now().strftime('%y-%m-%d %H:%M:%S'), level, SCRIPT_NAME, message))
-    sys.stdout.flush()
+    prefix = get_log_prefix()
+    if prefix:
+        message = '[{}] {}'.format(prefix, message)
+    line = '{} [{}] ({}) {}'.format(datetime.datetime.now().strftime('%y-%m-%d %H:%M:%S'), level, SCRIPT_NAME, message)
+    with _log_lock:
+        print(line)
+        sys.stdout.flush()
+    handler = get_log_handler()
+    if handler is not None:
+        handler(line)
 
 def one(iterables):
     heads = list(itertools.islice(iterables, 2))
@@ -26,16 +59,106 @@ def flatten(listoflists):
 def paginate(l, page_size):
     return [l[i:i+page_size] for i in xrange(0, len(l), page_size)]
 
-def attempt(what, how, max_try=30, interval=5):
-    for i in xrange(max_try):
+def parallel_map(func, items, max_workers=10):
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    prefix = get_log_prefix()
+    handler = get_log_handler()
+    def run(item):
+        set_log_prefix(prefix)
+        set_log_handler(handler)
+        return func(item)
+
+    pool = multiprocessing.pool.ThreadPool(min(len(items), max_workers))
+    try:
+        return pool.map(run, items)
+    finally:
+        pool.close()
+
+def run_dependency_graph(dependencies, func, max_workers):
+    # dependencies: { node: set of nodes that must succeed before node can start }
+    # Runs func(node) on up to max_workers threads as soon as a node's dependencies succeed.
+    # Nodes depending on a failed node are skipped. Returns (succeeded, failed, skipped).
+    pending = { node: set(deps) for node, deps in dependencies.iteritems() }
+    succeeded = []
+    failed = {}
+    running = set()
+    completed = Queue.Queue()
+    handler = get_log_handler()
+
+    prefix = get_log_prefix()
+
+    def run(node):
+        set_log_prefix('{}/{}'.format(prefix, node) if prefix else node)
+        set_log_handler(handler)
+        try:
+            func(node)
+            completed.put((node, None))
+        except Exception as e:
+            log(traceback.format_exc().rstrip(), level='ERROR')
+            completed.put((node, e))
+
+    while True:
+        ready = sorted(node for node, deps in pending.iteritems() if deps <= set(succeeded))
+        for node in ready[:max(max_workers - len(running), 0)]:
+            del pending[node]
+            running.add(node)
+            thread = threading.Thread(target=run, args=(node,))
+            thread.daemon = True
+            thread.start()
+
+        if len(running) == 0:
+            break
+
+        try:
+            node, error = completed.get(timeout=1)
+        except Queue.Empty:
+            continue
+        running.discard(node)
+        if error is None:
+            succeeded.append(node)
+        else:
+            failed[node] = error
+
+    return succeeded, failed, sorted(pending)
+
+class Backoff(object):
+    # Exponential backoff with jitter. The interval starts at min_interval, grows by factor
+    # while nothing changes and goes back to min_interval as soon as progress is reported.
+    def __init__(self, min_interval=1, max_interval=30, factor=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+
+    def sleep(self, progressed=False, deadline=None):
+        if progressed:
+            self.interval = self.min_interval
+        seconds = random.uniform(self.interval / 2.0, self.interval)
+        if deadline is not None:
+            seconds = max(min(seconds, deadline - time.time()), 0)
+        time.sleep(seconds)
+        self.interval = min(self.interval * self.factor, self.max_interval)
+
+def attempt(what, how, timeout=150, min_interval=1, max_interval=30):
+    # how() returns True once done. Any other return value is the observed state,
+    # a state different from the previous one counts as progress and resets the backoff.
+    deadline = time.time() + timeout
+    backoff = Backoff(min_interval=min_interval, max_interval=max_interval)
+    previous_state = None
+    i = 0
+    while True:
         if i > 0:
-            log('Attempting {} of {} to {}...'.format(i+1, max_try, what))
+            log('Attempt {} to {} ({:.0f}s left)...'.format(i+1, what, max(deadline - time.time(), 0)))
 
-        success = how()
-        if success:
+        state = how()
+        if state is True:
             return True
 
-        if i < max_try - 1:
-            time.sleep(interval)
+        if time.time() >= deadline:
+            return False
 
-    return False
+        backoff.sleep(progressed=i > 0 and state != previous_state, deadline=deadline)
+        previous_state = state
+        i += 1
@@ -0,0 +1,63 @@
+from __future__ import print_function
+from helper import *
+
+# Instances of an auto scaling group that are healthy in the group and in service in every
+# classic load balancer and target group of the group. A refresh costs one describe of the
+# group plus one call per load balancer and target group, made in parallel, which returns the
+# states of all their instances at once: every healthy instance is checked again on each
+# refresh, and the changes since the previous refresh are recorded.
+class InstanceHealth(object):
+    def __init__(self, asg_name, aws):
+        self.asg_name = asg_name
+        self.aws = aws
+        self.in_service = set()
+        self.pending = {}
+        self.changes = {'in_service': set(), 'out_of_service': set()}
+        self.refreshed_at = None
+
+    def refresh(self):
+        refreshed_at = time.time()
+        asg = one(self.aws.get_asgs([self.asg_name]))
+        healthy_instance_ids = set()
+        pending = {}
+        for instance in asg['Instances']:
+            if instance['HealthStatus'].upper() == 'HEALTHY':
+                healthy_instance_ids.add(instance['InstanceId'])
+            else:
+                pending[instance['InstanceId']] = ['auto scaling group: {} {}'.format(instance['LifecycleState'], instance['HealthStatus'])]
+
+        in_service = set()
+        load_balancers = [('elb', name) for name in asg.get('LoadBalancerNames', [])] + [('target-group', arn) for arn in asg.get('TargetGroupARNs', [])]
+        if len(healthy_instance_ids) > 0 and len(load_balancers) > 0:
+            states = parallel_map(self.get_states, load_balancers)
+            for instance_id in healthy_instance_ids:
+                reasons = ['{} {}: {}'.format(kind, get_load_balancer_name(name), s.get(instance_id, 'not registered'))
+                           for (kind, name), s in zip(load_balancers, states) if s.get(instance_id, '').lower() not in ['inservice', 'healthy']]
+                if len(reasons) > 0:
+                    pending[instance_id] = reasons
+                else:
+                    in_service.add(instance_id)
+        else:
+            in_service |= healthy_instance_ids
+
+        self.changes = {'in_service': in_service - self.in_service, 'out_of_service': self.in_service - in_service}
+        self.in_service = in_service
+        self.pending = pending
+        self.refreshed_at = refreshed_at
+        return self
+
+    def get_states(self, load_balancer):
+        kind, name = load_balancer
+        if kind == 'elb':
+            return self.aws.get_elb_instance_states(name)
+        return self.aws.get_target_group_states(name)
+
+    def describe_pending(self, limit=10):
+        descriptions = ['{} ({})'.format(instance_id, ', '.join(self.pending[instance_id])) for instance_id in sorted(self.pending)]
+        if len(descriptions) > limit:
+            descriptions = descriptions[:limit] + ['{} more'.format(len(descriptions) - limit)]
+        return ', '.join(descriptions)
+
+def get_load_balancer_name(name):
+    # arn:aws:elasticloadbalancing:region:account:targetgroup/name/id -> name
+    return name.split(':targetgroup/')[-1].split('/')[0]
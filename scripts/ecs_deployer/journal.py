@@ -0,0 +1,102 @@
+from __future__ import print_function
+import hashlib
+import json
+import os
+import threading
+from helper import *
+
+# Durable record of the progress of one component's deployment, so that a deployment which
+# got interrupted (e.g. the CI agent was recycled during a drain) can be resumed from the
+# last completed phase. The journal is a JSON lines file, every line is flushed to disk
+# before the deployment moves on:
+#   {"set": {"key": value, ...}}   sets keys of the state
+#   {"add": {"key": [items]}}      appends items to a list of the state
+# The file is removed once the deployment has finished. The hash of the last successful
+# deployment is kept next to it, so that deploying the same content again onto the same,
+# untouched stack costs no comparison with the stack.
+
+# The journals must outlive the process, run.sh mounts a host directory into the container
+# and points this variable at it.
+JOURNAL_DIR_VARIABLE = 'ECS_DEPLOYER_JOURNAL_DIR'
+
+def get_default_journal_dir():
+    return os.environ.get(JOURNAL_DIR_VARIABLE) or '.ecs_deployer'
+
+def get_journal_path(journal_dir, environment, region, component_name):
+    return os.path.join(journal_dir, '{}-{}-{}.jsonl'.format(environment, region, component_name))
+
+def get_deployment_hash(template, inputs, tags):
+    content = json.dumps([json.loads(template), sorted(inputs, key=lambda i: i['ParameterKey']), sorted(tags, key=lambda t: t['Key'])], sort_keys=True)
+    return hashlib.sha256(content).hexdigest()
+
+class Journal(object):
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    # a line cut short by the interruption is ignored, it was never acted upon
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.apply(entry)
+
+    def apply(self, entry):
+        self.state.update(entry.get('set', {}))
+        for key, items in entry.get('add', {}).iteritems():
+            self.state[key] = self.state.get(key, []) + items
+
+    def write(self, entry):
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.apply(entry)
+
+    def set(self, **values):
+        self.write({'set': values})
+
+    def add(self, key, items):
+        if len(items) > 0:
+            self.write({'add': {key: items}})
+
+    def is_completed(self, phase):
+        return phase in self.state.get('completed_phases', [])
+
+    def complete(self, phase):
+        self.add('completed_phases', [phase])
+
+    def get_last_deployment_path(self):
+        return os.path.splitext(self.path)[0] + '.last.json'
+
+    def get_last_deployment(self):
+        path = self.get_last_deployment_path()
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                return {}
+
+    def set_last_deployment(self, **values):
+        path = self.get_last_deployment_path()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(values, f, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def finish(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.state = {}
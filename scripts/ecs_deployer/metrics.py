@@ -0,0 +1,134 @@
+from __future__ import print_function
+import collections
+import contextlib
+import json
+import threading
+import time
+from helper import *
+
+THROTTLING_ERROR_CODES = set(['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                              'TooManyRequestsException', 'RequestLimitExceeded', 'Rate exceeded', 'SlowDown'])
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+def is_throttling_error(error_code):
+    return error_code in THROTTLING_ERROR_CODES
+
+# Records per service/operation AWS API statistics by hooking into boto3's event system,
+# and the duration of the deployment phases. A long running process keeps only the last
+# max_phases phases.
+class Metrics(object):
+    def __init__(self, max_phases=None):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.operations = {}
+        self.phases = collections.deque(maxlen=max_phases)
+
+    def instrument(self, client):
+        events = client.meta.events
+        # registered first so that handlers returning a response (e.g. botocore's retry handler) cannot short-circuit them
+        events.register_first('before-call', self._before_call)
+        events.register('after-call', self._after_call)
+        events.register_first('needs-retry', self._needs_retry)
+        return client
+
+    def _get_operation(self, service, operation):
+        key = (service, operation)
+        if key not in self.operations:
+            self.operations[key] = {
+                'service': service,
+                'operation': operation,
+                'calls': 0,
+                'errors': 0,
+                'retries': 0,
+                'throttles': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)
+            }
+        return self.operations[key]
+
+    def _before_call(self, model, context, **kwargs):
+        context['metrics_started_at'] = time.time()
+
+    def _after_call(self, model, context, http_response, parsed, **kwargs):
+        elapsed_ms = max(time.time() - context.get('metrics_started_at', time.time()), 0) * 1000
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= bound), len(LATENCY_BUCKETS_MS))
+        with self.lock:
+            stats = self._get_operation(model.service_model.service_name, model.name)
+            stats['calls'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['histogram'][bucket] += 1
+            stats['retries'] += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if 'Error' in parsed:
+                stats['errors'] += 1
+
+    def _needs_retry(self, response, operation, **kwargs):
+        if response is None:
+            return None
+        error_code = response[1].get('Error', {}).get('Code')
+        if is_throttling_error(error_code):
+            with self.lock:
+                self._get_operation(operation.service_model.service_name, operation.name)['throttles'] += 1
+        return None
+
+    def add_phase(self, name, started_at, succeeded=True):
+        record = {'phase': name, 'component': get_log_prefix(), 'started_at': started_at, 'seconds': round(time.time() - started_at, 3), 'succeeded': succeeded}
+        with self.lock:
+            self.phases.append(record)
+        return record
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started_at = time.time()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            record = self.add_phase(name, started_at, succeeded)
+            log('Phase {} {} after {:.0f}s.'.format(name, 'finished' if succeeded else 'failed', record['seconds']))
+
+    def get_report(self):
+        with self.lock:
+            operations = sorted((dict(o, histogram=list(o['histogram'])) for o in self.operations.itervalues()), key=lambda o: (o['service'], o['operation']))
+            phases = [dict(p) for p in self.phases]
+        return {
+            'started_at': self.started_at,
+            'seconds': round(time.time() - self.started_at, 3),
+            'latency_buckets_ms': LATENCY_BUCKETS_MS,
+            'operations': operations,
+            'phases': phases
+        }
+
+    def write_report(self, path, **extra):
+        report = dict(self.get_report(), **extra)
+        if path.endswith('.jsonl'):
+            # one line per run, so that runs can be appended to the same file
+            with open(path, 'a') as f:
+                f.write(json.dumps(report, sort_keys=True) + '\n')
+        else:
+            with open(path, 'w') as f:
+                json.dump(report, f, sort_keys=True, indent=2)
+        log('Metrics report written to {}'.format(path))
+
+    def log_summary(self, limit=10):
+        report = self.get_report()
+        operations = sorted(report['operations'], key=lambda o: o['total_ms'], reverse=True)
+        log('AWS API calls after {:.0f}s: {} calls, {} retries, {} throttles'.format(
+            report['seconds'], sum(o['calls'] for o in operations), sum(o['retries'] for o in operations), sum(o['throttles'] for o in operations)))
+        for o in operations[:limit]:
+            log('  {}.{}: {} calls, avg {:.0f}ms, max {:.0f}ms, {} retries, {} throttles'.format(
+                o['service'], o['operation'], o['calls'], o['total_ms'] / max(o['calls'], 1), o['max_ms'], o['retries'], o['throttles']))
+
+    def start_summary_logger(self, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                self.log_summary()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
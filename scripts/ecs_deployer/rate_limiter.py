@@ -0,0 +1,88 @@
+from __future__ import print_function
+import threading
+import time
+from helper import *
+from metrics import is_throttling_error
+
+# calls per second per service and region, the default of ecs_deployer --api-rate-limit
+DEFAULT_RATE = 10
+
+# Token bucket shared by every thread calling one AWS service in one region.
+# Throttling halves the rate (at most once per cooldown), every successful call then
+# recovers a small fraction of the configured rate.
+class TokenBucket(object):
+    def __init__(self, name, rate, burst=None, min_rate=0.5, recovery=0.02, cooldown=1.0):
+        self.name = name
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.min_rate = min(min_rate, self.max_rate)
+        self.recovery = recovery
+        self.cooldown = cooldown
+        self.tokens = self.burst
+        self.updated_at = time.time()
+        self.decreased_at = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.burst)
+        self.updated_at = now
+
+    def acquire(self):
+        # reserve a token straight away, tokens may go negative and later callers queue up behind
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_throttle(self):
+        with self.lock:
+            now = time.time()
+            if now - self.decreased_at < self.cooldown:
+                return
+            self._refill(now)
+            self.rate = max(self.rate / 2, self.min_rate)
+            self.decreased_at = now
+            rate = self.rate
+        log('Throttled by {}, slowing down to {:.1f} calls/s'.format(self.name, rate), level='WARN')
+
+    def on_success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill(time.time())
+                self.rate = min(self.rate + self.max_rate * self.recovery, self.max_rate)
+
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, region, service):
+        key = (region, service)
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(name='{} in {}'.format(service, region), rate=self.rate)
+            return self.buckets[key]
+
+    def instrument(self, client):
+        bucket = self.get_bucket(client.meta.region_name, client.meta.service_model.service_name)
+
+        # before-send is emitted for every HTTP attempt, including botocore's retries
+        def before_send(**kwargs):
+            bucket.acquire()
+
+        def needs_retry(response, **kwargs):
+            if response is not None:
+                if is_throttling_error(response[1].get('Error', {}).get('Code')):
+                    bucket.on_throttle()
+                elif response[0].status_code < 400:
+                    bucket.on_success()
+            return None
+
+        client.meta.events.register_first('before-send', before_send)
+        client.meta.events.register_first('needs-retry', needs_retry)
+        return client
@@ -0,0 +1,398 @@
+from __future__ import print_function
+import BaseHTTPServer
+import collections
+import contextlib
+import hmac
+import httplib
+import itertools
+import json
+import os
+import socket
+import sys
+import SocketServer
+import threading
+import time
+import traceback
+import urlparse
+from helper import *
+from cluster_state import *
+
+# Server mode: one long running process keeps the AWS clients and stack outputs warm, and runs
+# the deployments requested over a local HTTP API concurrently. Deployments of the same cluster
+# wait for each other. Cluster snapshots are not cached: deployments plan capacity and drain
+# from current ones.
+#
+#   POST /jobs                          {"argv": [ecs_deployer arguments], "config": "<config-file content>"}
+#                                       config may also be {"<region>": "<config-file content>", ...}
+#   GET  /jobs                          all jobs
+#   GET  /jobs/<id>                     one job
+#   GET  /jobs/<id>/logs                the job's log lines as JSON lines ({"log": line}) until the job
+#                                       finishes, then a last {"job": {...}} line
+#   GET  /status                        uptime, jobs, locked clusters and AWS calls per region
+#   GET  /clusters/<region>/<cluster>   running tasks per container instance, described on request
+#
+# Jobs run with the AWS credentials of the server. By default it listens on a Unix socket
+# (unix:/path) only accessible by its owner. It can listen on a loopback address instead
+# (127.0.0.1:port), then every request must carry the token of ECS_DEPLOYER_SERVER_TOKEN
+# (Authorization: Bearer <token>), set for both the server and its clients. POST bodies must be
+# application/json, which browsers do not send to another origin without asking first.
+
+MAX_FINISHED_JOBS = 100
+# the server only keeps the last lines of the log of each job, and the last phases of each region
+MAX_JOB_LOG_LINES = 10000
+MAX_PHASES = 1000
+
+def parse_address(address):
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return 'inet', (host or '127.0.0.1', int(port))
+
+def get_server_token():
+    return os.environ.get(SERVER_TOKEN_VARIABLE) or None
+
+class Job(object):
+    def __init__(self, job_id, request):
+        self.id = job_id
+        self.request = request
+        self.status = 'queued'
+        self.error = None
+        self.lines = collections.deque(maxlen=MAX_JOB_LOG_LINES)
+        self.line_count = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cond = threading.Condition()
+
+    def start(self):
+        with self.cond:
+            self.status = 'running'
+            self.started_at = time.time()
+
+    def append(self, line):
+        with self.cond:
+            self.lines.append(line)
+            self.line_count += 1
+            self.cond.notify_all()
+
+    def finish(self, error):
+        with self.cond:
+            self.status = 'failed' if error else 'succeeded'
+            self.error = error
+            self.finished_at = time.time()
+            self.cond.notify_all()
+
+    def is_finished(self):
+        return self.finished_at is not None
+
+    def follow(self):
+        # yields the log lines, waiting for new ones until the job has finished. The lines
+        # dropped from the log before they could be sent are replaced by a note.
+        offset = 0
+        while True:
+            with self.cond:
+                while offset == self.line_count and not self.is_finished():
+                    self.cond.wait(1)
+                first = self.line_count - len(self.lines)
+                lines = list(itertools.islice(self.lines, max(offset - first, 0), None))
+                finished = self.is_finished()
+            if offset < first:
+                yield '({} log lines dropped)'.format(first - offset)
+            for line in lines:
+                yield line
+            offset = max(offset, first) + len(lines)
+            if finished:
+                return
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'argv': self.request.get('argv'),
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'log_lines': self.line_count
+        }
+
+# One lock per cluster, a deployment waits while another one holds the lock of its cluster.
+class ClusterLocks(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.owners = {}
+
+    @contextlib.contextmanager
+    def hold(self, key, owner):
+        with self.cond:
+            if key in self.owners:
+                log('Cluster {} is being deployed by {}, waiting for it to finish.'.format(key, self.owners[key]))
+            while key in self.owners:
+                self.cond.wait(1)
+            self.owners[key] = owner
+        try:
+            yield
+        finally:
+            with self.cond:
+                del self.owners[key]
+                self.cond.notify_all()
+
+    def get_owners(self):
+        with self.cond:
+            return dict(self.owners)
+
+class DeployServer(object):
+    def __init__(self, execute, create_region):
+        # execute(request, server) runs a job on its own thread,
+        # create_region(region) returns the (aws, stack_outputs) shared by all jobs in that region
+        self.execute = execute
+        self.create_region = create_region
+        self.started_at = time.time()
+        self.jobs = collections.OrderedDict()
+        self.job_ids = itertools.count(1)
+        self.regions = {}
+        self.cluster_locks = ClusterLocks()
+        self.lock = threading.Lock()
+
+    def get_region(self, region):
+        with self.lock:
+            if region not in self.regions:
+                self.regions[region] = self.create_region(region)
+            return self.regions[region]
+
+    def get_cluster_state(self, region, cluster_name):
+        aws, _ = self.get_region(region)
+        return ClusterState(cluster_name=cluster_name, aws=aws).refresh()
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def get_jobs(self):
+        with self.lock:
+            return self.jobs.values()
+
+    def submit(self, request):
+        job = Job(str(next(self.job_ids)), request)
+        with self.lock:
+            finished = [j for j in self.jobs.itervalues() if j.is_finished()]
+            for j in finished[:max(len(finished) - MAX_FINISHED_JOBS + 1, 0)]:
+                del self.jobs[j.id]
+            self.jobs[job.id] = job
+
+        thread = threading.Thread(target=self.run, args=(job,))
+        thread.daemon = True
+        thread.start()
+        log('Job {} started: {}'.format(job.id, ' '.join(request['argv'])))
+        return job
+
+    def run(self, job):
+        set_log_handler(job.append)
+        job.start()
+        error = None
+        try:
+            self.execute(job.request, self)
+        except Exception as e:
+            log(traceback.format_exc().rstrip(), level='ERROR')
+            error = str(e) or e.__class__.__name__
+        finally:
+            set_log_handler(None)
+        job.finish(error)
+        log('Job {} {}.'.format(job.id, job.status))
+
+    def get_status(self):
+        jobs = self.get_jobs()
+        with self.lock:
+            regions = dict(self.regions)
+        return {
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'jobs': collections.Counter(j.status for j in jobs),
+            'locked_clusters': self.cluster_locks.get_owners(),
+            'regions': {region: {
+                'calls': sum(o['calls'] for o in aws.metrics.get_report()['operations']),
+                'throttles': sum(o['throttles'] for o in aws.metrics.get_report()['operations']),
+                'cached_stacks': len(stack_outputs.outputs)
+            } for region, (aws, stack_outputs) in regions.iteritems()}
+        }
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = 'ecs_deployer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, body):
+        content = json.dumps(body, sort_keys=True)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def get_path(self):
+        return [part for part in urlparse.urlparse(self.path).path.split('/') if part]
+
+    def is_authorized(self):
+        if self.server.token is None:
+            return True
+        if hmac.compare_digest(self.headers.getheader('Authorization', ''), 'Bearer ' + self.server.token):
+            return True
+        self.send_json(401, {'error': 'Missing or invalid token, see {}'.format(SERVER_TOKEN_VARIABLE)})
+        return False
+
+    def do_GET(self):
+        if not self.is_authorized():
+            return
+        deploy_server = self.server.deploy_server
+        path = self.get_path()
+        try:
+            if path == ['status']:
+                self.send_json(200, deploy_server.get_status())
+            elif path == ['jobs']:
+                self.send_json(200, {'jobs': [j.to_dict() for j in deploy_server.get_jobs()]})
+            elif len(path) in [2, 3] and path[0] == 'jobs' and path[2:] in [[], ['logs']]:
+                job = deploy_server.get_job(path[1])
+                if job is None:
+                    self.send_json(404, {'error': 'Job {} not found'.format(path[1])})
+                elif len(path) == 2:
+                    self.send_json(200, {'job': job.to_dict()})
+                else:
+                    self.stream_logs(job)
+            elif len(path) == 3 and path[0] == 'clusters':
+                cluster_state = deploy_server.get_cluster_state(path[1], path[2])
+                self.send_json(200, {
+                    'cluster': path[2],
+                    'refreshed_at': cluster_state.refreshed_at,
+                    'tasks': len(cluster_state.tasks),
+                    'tasks_by_instance': {arn: len(tasks) for arn, tasks in cluster_state.tasks_by_instance.iteritems()}
+                })
+            else:
+                self.send_json(404, {'error': 'Not found'})
+        except socket.error:
+            pass
+        except Exception as e:
+            log(traceback.format_exc().rstrip(), level='ERROR')
+            self.send_json(500, {'error': str(e)})
+
+    def do_POST(self):
+        if not self.is_authorized():
+            return
+        if self.get_path() != ['jobs']:
+            self.send_json(404, {'error': 'Not found'})
+            return
+        if self.headers.gettype() != 'application/json':
+            self.send_json(415, {'error': 'The Content-Type must be application/json'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+        except ValueError as e:
+            self.send_json(400, {'error': 'Invalid JSON: {}'.format(e)})
+            return
+        config = request.get('config')
+        if not isinstance(request.get('argv'), list) or not (isinstance(config, basestring) or isinstance(config, dict) and all(isinstance(c, basestring) for c in config.itervalues())):
+            self.send_json(400, {'error': 'A job needs argv (a list) and config (the config-file content, or the content per region)'})
+            return
+        job = self.server.deploy_server.submit(request)
+        self.send_json(200, {'job': job.to_dict()})
+
+    def stream_logs(self, job):
+        # no Content-Length, the response ends when the connection is closed
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for line in job.follow():
+            self.wfile.write(json.dumps({'log': line}) + '\n')
+            self.wfile.flush()
+        self.wfile.write(json.dumps({'job': job.to_dict()}, sort_keys=True) + '\n')
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def create_http_server(address, deploy_server, token):
+    family, location = parse_address(address)
+    if family == 'inet' and not socket.gethostbyname(location[0]).startswith('127.'):
+        raise Exception('The server only listens on a loopback address or a Unix socket, not on {}'.format(address))
+    if family == 'inet' and token is None:
+        raise Exception('Set {} to listen on {}, or listen on a Unix socket (unix:/path)'.format(SERVER_TOKEN_VARIABLE, address))
+    if family == 'unix':
+        if os.path.exists(location):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(location)
+                raise Exception('Another server is listening on {}'.format(address))
+            except socket.error:
+                os.remove(location)
+            finally:
+                probe.close()
+        # created with mode 600, no other user can connect even for a moment
+        umask = os.umask(0177)
+        try:
+            http_server = ThreadingUnixHTTPServer(location, RequestHandler)
+        finally:
+            os.umask(umask)
+    else:
+        http_server = ThreadingHTTPServer(location, RequestHandler)
+    http_server.deploy_server = deploy_server
+    http_server.token = token
+    return http_server
+
+def serve(address, deploy_server, token=None):
+    http_server = create_http_server(address, deploy_server, token)
+    log('Listening on {}'.format(address))
+    try:
+        http_server.serve_forever()
+    finally:
+        http_server.server_close()
+        family, location = parse_address(address)
+        if family == 'unix' and os.path.exists(location):
+            os.remove(location)
+
+# -- client ------------------------------------------------------------------------------
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+def send_request(address, method, path, body=None, token=None):
+    family, location = parse_address(address)
+    connection = UnixHTTPConnection(location) if family == 'unix' else httplib.HTTPConnection(*location)
+    headers = {'Content-Type': 'application/json'}
+    if token is not None:
+        headers['Authorization'] = 'Bearer ' + token
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+    except socket.error as e:
+        raise Exception('Cannot reach the server at {}: {}'.format(address, e))
+    return connection.getresponse()
+
+def submit_job(address, argv, config, token=None):
+    response = send_request(address, 'POST', '/jobs', {'argv': argv, 'config': config}, token=token)
+    body = json.loads(response.read())
+    if response.status != 200:
+        raise Exception('The server at {} refused the job: {}'.format(address, body.get('error')))
+    return body['job']
+
+def follow_job(address, job_id, token=None):
+    # prints the job's log lines as they come, returns the finished job
+    response = send_request(address, 'GET', '/jobs/{}/logs'.format(job_id), token=token)
+    if response.status != 200:
+        raise Exception('Cannot follow job {} on {}: {}'.format(job_id, address, json.loads(response.read()).get('error')))
+    job = None
+    for line in iter(response.fp.readline, ''):
+        entry = json.loads(line)
+        if 'log' in entry:
+            print(entry['log'])
+            sys.stdout.flush()
+        else:
+            job = entry['job']
+    if job is None:
+        raise Exception('Lost the connection to {} while following job {}'.format(address, job_id))
+    return job
@@ -0,0 +1,80 @@
+from __future__ import print_function
+import re
+from helper import *
+
+# Structural comparison of two CloudFormation templates. A change only needs a blue/green
+# replacement of the stack when it affects the instances: the auto scaling groups, launch
+# configurations and launch templates, or anything they refer to (resources, parameters,
+# conditions and mappings, followed transitively). Every other change is applied in place.
+
+INSTANCE_RESOURCE_TYPES = ['AWS::AutoScaling::AutoScalingGroup', 'AWS::AutoScaling::LaunchConfiguration', 'AWS::EC2::LaunchTemplate']
+
+def diff_resources(old_template, new_template):
+    # {logical id: 'added', 'removed' or 'modified'}
+    old_resources = old_template.get('Resources', {})
+    new_resources = new_template.get('Resources', {})
+    changes = {}
+    for logical_id in set(old_resources) | set(new_resources):
+        if logical_id not in old_resources:
+            changes[logical_id] = 'added'
+        elif logical_id not in new_resources:
+            changes[logical_id] = 'removed'
+        elif old_resources[logical_id] != new_resources[logical_id]:
+            changes[logical_id] = 'modified'
+    return changes
+
+def diff_sections(old_template, new_template):
+    # [(section, name)] of the parameters, conditions and mappings that were added, removed or modified
+    changes = []
+    for section in ['Parameters', 'Conditions', 'Mappings']:
+        old_entries = old_template.get(section, {})
+        new_entries = new_template.get(section, {})
+        changes += [(section, name) for name in sorted(set(old_entries) | set(new_entries)) if old_entries.get(name) != new_entries.get(name)]
+    return changes
+
+def get_references(value):
+    # names of the resources, parameters, conditions and mappings used by a part of a template
+    references = set()
+    if isinstance(value, dict):
+        for key, v in value.iteritems():
+            if key in ['Ref', 'DependsOn', 'Condition'] and isinstance(v, basestring):
+                references.add(v)
+            elif key == 'DependsOn' and isinstance(v, list):
+                references |= set(v)
+            elif key == 'Fn::GetAtt':
+                references.add(v[0] if isinstance(v, list) else v.split('.')[0])
+            elif key in ['Fn::FindInMap', 'Fn::If'] and isinstance(v, list) and isinstance(v[0], basestring):
+                references.add(v[0])
+            elif key == 'Fn::Sub':
+                template = v[0] if isinstance(v, list) else v
+                references |= {name.split('.')[0] for name in re.findall(r'\$\{([^!}][^}]*)\}', template)}
+            references |= get_references(v)
+    elif isinstance(value, list):
+        for v in value:
+            references |= get_references(v)
+    return references
+
+def get_instance_dependencies(template):
+    # the instance resources and everything they refer to
+    resources = template.get('Resources', {})
+    conditions = template.get('Conditions', {})
+    pending = [logical_id for logical_id, resource in resources.iteritems() if resource.get('Type') in INSTANCE_RESOURCE_TYPES]
+    dependencies = set()
+    while len(pending) > 0:
+        name = pending.pop()
+        if name in dependencies:
+            continue
+        dependencies.add(name)
+        pending += list(get_references(resources.get(name, conditions.get(name))) - dependencies)
+    return dependencies
+
+def get_replacement_reasons(old_template, new_template, changed_inputs, size_parameters):
+    # the changes which require replacing the stack, none when it can be updated in place
+    if old_template is None:
+        return ['the existing template cannot be compared']
+    dependencies = get_instance_dependencies(old_template) | get_instance_dependencies(new_template)
+    reasons = ['resource {} {}'.format(logical_id, change) for logical_id, change in sorted(diff_resources(old_template, new_template).iteritems()) if logical_id in dependencies]
+    reasons += ['{} {} changed'.format(section[:-1].lower(), name) for section, name in diff_sections(old_template, new_template)
+                if name in dependencies and not (section == 'Parameters' and name in size_parameters)]
+    reasons += ['input {} changed'.format(key) for key in changed_inputs if key in dependencies and key not in size_parameters]
+    return reasons
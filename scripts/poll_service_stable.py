@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 #
-# Poll until the ECS service and its tasks are stable
+# Poll until ECS services and their tasks are stable
 
 from __future__ import print_function
 import argparse
 import datetime
 import itertools
+import random
 import time
 import sys
 import boto3
@@ -13,11 +14,16 @@ import boto3
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--cluster-name', dest='cluster_name', required=True, help='Name of the ECS Cluster')
-    parser.add_argument('--service-arn', dest='service_arn', required=True, help='ARN of the ECS Service')
+    parser.add_argument('--service-arn', dest='service_arns', nargs='+', metavar='SERVICE_ARN', help='ARN(s) of the ECS Service(s), polled together')
+    parser.add_argument('--all-services', dest='all_services', default=False, action='store_true', help='Poll every service of the cluster')
     parser.add_argument('--full-image-name', dest='full_image_name', required=False, help='Full image name: e.g. REPO_URL:BUILD_NUMBER')
-    parser.add_argument('--attempts', default=30, type=int, help='Number of poll attempts before reporting error')
-    parser.add_argument('--interval', default=5, type=int, help='Number of seconds between each attempt')
-    return parser.parse_args()
+    parser.add_argument('--timeout', type=int, help='Number of seconds to poll before reporting error, defaults to --attempts * --interval')
+    parser.add_argument('--attempts', default=30, type=int, help='Used to compute the default --timeout')
+    parser.add_argument('--interval', default=5, type=int, help='Maximum number of seconds between each attempt. Polls start faster and back off while nothing changes.')
+    args = parser.parse_args()
+    if not args.service_arns and not args.all_services:
+        parser.error('--service-arn or --all-services is required')
+    return args
 
 def log(message):
     print('{} {}'.format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message))
@@ -36,110 +42,239 @@ def flatten(listoflists):
 def paginate(l, page_size):
     return [l[i:i+page_size] for i in xrange(0, len(l), page_size)]
 
-def get_service(cluster_name, service_arn, ecs_client):
-    response = ecs_client.describe_services(cluster=cluster_name, services=[service_arn])
-    if len(response['failures']) > 0:
-        raise Exception("Failed to describe ECS services. {}".format(response['failures']))
-    return one(response['services'])
-
-def get_tasks(cluster_name, service_arn, ecs_client):
-    def get_tasks_batch(arns):
-        response = ecs_client.describe_tasks(cluster=cluster_name, tasks=arns)
+# Same as helper.Backoff of ecs_deployer: the scripts of this directory are standalone and import
+# nothing from it. tests/test_poll_service_stable.py checks that the two do not drift apart.
+class Backoff(object):
+    # Exponential backoff with jitter. The interval starts at min_interval, grows by factor
+    # while nothing changes and goes back to min_interval as soon as progress is reported.
+    def __init__(self, min_interval=1, max_interval=30, factor=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+
+    def sleep(self, progressed=False, deadline=None):
+        if progressed:
+            self.interval = self.min_interval
+        seconds = random.uniform(self.interval / 2.0, self.interval)
+        if deadline is not None:
+            seconds = max(min(seconds, deadline - time.time()), 0)
+        time.sleep(seconds)
+        self.interval = min(self.interval * self.factor, self.max_interval)
+
+def get_service_arns(cluster_name, ecs_client):
+    return flatten(p['serviceArns'] for p in ecs_client.get_paginator('list_services').paginate(cluster=cluster_name))
+
+def get_service_name(arn):
+    # arn:aws:ecs:region:account:service/cluster/name (or service/name) -> name, a name is returned as is
+    return arn.split('/')[-1]
+
+def unique_services(service_arns):
+    # the first ARN or name of each service, a service may be asked both by ARN and by name
+    names = set()
+    unique = []
+    for arn in service_arns:
+        if get_service_name(arn) not in names:
+            names.add(get_service_name(arn))
+            unique.append(arn)
+    return unique
+
+def get_services(cluster_name, service_arns, ecs_client):
+    # returns the services by every ARN or name they were asked with, each service is described once
+    def get_services_batch(arns):
+        response = ecs_client.describe_services(cluster=cluster_name, services=arns)
+        if len(response['failures']) > 0:
+            raise Exception("Failed to describe ECS services. {}".format(response['failures']))
+        return [(arn, service) for service in response['services'] for arn in service_arns if arn in [service['serviceArn'], service['serviceName']]]
+
+    return dict(flatten(get_services_batch(arns) for arns in paginate(unique_services(service_arns), page_size=10)))
+
+# RUNNING tasks of a cluster indexed by ARN, shared by all the services being polled. A refresh
+# lists the task ARNs and only describes the tasks it has not seen before, the tasks which are
+# no longer listed are dropped.
+class TaskIndex(object):
+    def __init__(self, cluster_name, ecs_client):
+        self.cluster_name = cluster_name
+        self.ecs_client = ecs_client
+        self.tasks = {}
+
+    def refresh(self):
+        task_arns = flatten(p['taskArns'] for p in self.ecs_client.get_paginator('list_tasks').paginate(cluster=self.cluster_name, desiredStatus='RUNNING'))
+        new_tasks = {task['taskArn']: task for task in flatten(self.describe_tasks(arns) for arns in paginate([arn for arn in task_arns if arn not in self.tasks], page_size=100))}
+        tasks = {arn: self.tasks.get(arn) or new_tasks[arn] for arn in task_arns}
+        changed = len(new_tasks) > 0 or len(tasks) != len(self.tasks)
+        self.tasks = tasks
+        return changed
+
+    def describe_tasks(self, arns):
+        response = self.ecs_client.describe_tasks(cluster=self.cluster_name, tasks=arns)
         if len(response['failures']) > 0:
             raise Exception("Failed to describe ECS tasks. {}".format(response['failures']))
         return response['tasks']
 
-    task_arns = flatten(p['taskArns'] for p in ecs_client.get_paginator('list_tasks').paginate(cluster=cluster_name, serviceName=service_arn, desiredStatus='RUNNING'))
-    tasks = flatten(get_tasks_batch(arns) for arns in paginate(task_arns, page_size=100))
-    return tasks
-
-def poll(cluster_name, service_arn, attempts, interval, ecs_client):
-    def is_service_stable(service, tasks):
-        if service['runningCount'] < service['desiredCount']:
-            log('Only {} tasks are running. Require at least {} tasks.'.format(service['runningCount'], service['desiredCount']))
-            return False
-
-        if len(tasks) != service['runningCount']:
-            log('Actual tasks count ({}) has not matched runningCount ({}).'.format(len(tasks), service['runningCount']))
-            return False
-
+    def get_service_tasks(self, service):
+        return [task for task in self.tasks.itervalues() if task.get('group') == 'service:' + service['serviceName']]
+
+# Task definitions never change once registered, each one is described once.
+class TaskDefinitions(object):
+    def __init__(self, ecs_client):
+        self.ecs_client = ecs_client
+        self.task_definitions = {}
+
+    def get(self, task_definition_arn):
+        if task_definition_arn not in self.task_definitions:
+            self.task_definitions[task_definition_arn] = self.ecs_client.describe_task_definition(taskDefinition=task_definition_arn)['taskDefinition']
+        return self.task_definitions[task_definition_arn]
+
+def poll(cluster_name, service_arns, timeout, interval, ecs_client, task_definitions=None):
+    # A service is stable once its only deployment has rolled out, and the latest service event,
+    # newer than the deployment, says it has reached a steady state. Each tick describes the
+    # services still being polled 10 at a time, and lists the tasks of the cluster once, only if
+    # a service looks stable. Returns {service arn: (service, 'stable', 'failed' or 'timeout')}.
+    def log_service(service, message):
+        log('{}: {}'.format(service['serviceName'], message) if len(service_arns) > 1 else message)
+
+    def is_service_stable(service):
         if len(service['deployments']) != 1:
-            log('There are {} deployments.'.format(len(service['deployments'])))
+            log_service(service, 'There are {} deployments.'.format(len(service['deployments'])))
             return False
 
-        if not last_service_snapshot:
-            log('This is the first check. More data is required.')
+        deployment = service['deployments'][0]
+        if deployment.get('rolloutState', 'COMPLETED') != 'COMPLETED':
+            log_service(service, 'Deployment {} is {}: {}'.format(deployment['id'], deployment['rolloutState'], deployment.get('rolloutStateReason', '')))
             return False
 
-        if len(last_service_snapshot['events']) == 0 or len(service['events']) == 0:
-            log('No service events collected. More data is required.')
+        if service['runningCount'] < service['desiredCount']:
+            log_service(service, 'Only {} tasks are running. Require at least {} tasks.'.format(service['runningCount'], service['desiredCount']))
             return False
 
-        if last_service_snapshot['events'][0]['id'] != service['events'][0]['id']:
-            log('Latest service event has changed since last poll. The service is not stable yet.')
+        if len(service['events']) == 0:
+            log_service(service, 'No service events collected. More data is required.')
             return False
 
-        log('Last event is: {}'.format(service['events'][0]['message']))
+        log_service(service, 'Last event is: {}'.format(service['events'][0]['message']))
 
         if 'has reached a steady state' not in service['events'][0]['message'].lower():
-            log('Latest service event does not indicate the service has been stable yet.')
+            log_service(service, 'Latest service event does not indicate the service has been stable yet.')
             return False
 
-        if {task['taskArn'] for task in tasks} != {task['taskArn'] for task in last_tasks_snapshot}:
-            log('Tasks have changed since last poll. The service is not sable yet.')
+        if service['events'][0]['createdAt'] < deployment['updatedAt']:
+            log_service(service, 'Latest steady state event is older than the deployment. The service is not stable yet.')
+            return False
+
+        if not tasks_refreshed[0]:
+            task_index.refresh()
+            tasks_refreshed[0] = True
+        tasks = task_index.get_service_tasks(service)
+
+        if len(tasks) != service['runningCount']:
+            log_service(service, 'Actual tasks count ({}) has not matched runningCount ({}).'.format(len(tasks), service['runningCount']))
             return False
 
         if any(task['taskDefinitionArn'] != service['taskDefinition'] for task in tasks):
-            log("Not all tasks' task definition match the service's task definition.")
+            log_service(service, "Not all tasks' task definition match the service's task definition.")
             return False
 
         return True
 
+    def has_failed(service):
+        return any(d.get('rolloutState') == 'FAILED' for d in service['deployments'] if d['status'] == 'PRIMARY')
 
-    last_service_snapshot = None
-    last_tasks_snapshot = []
-
-    for i in xrange(attempts):
+    def has_progressed(service, last_service):
+        if last_service is None:
+            return False
+        if service['runningCount'] != last_service['runningCount']:
+            return True
+        if [d.get('rolloutState') for d in service['deployments']] != [d.get('rolloutState') for d in last_service['deployments']]:
+            return True
+        return [e['id'] for e in service['events'][:1]] != [e['id'] for e in last_service['events'][:1]]
+
+    task_index = TaskIndex(cluster_name, ecs_client)
+    last_services = {}
+    results = {}
+
+    deadline = time.time() + timeout
+    backoff = Backoff(min_interval=min(2, interval), max_interval=interval)
+    i = 0
+    while True:
+        polling = [arn for arn in service_arns if arn not in results]
         if i > 0:
-            log('Attempting {} of {}...'.format(i+1, attempts))
-
-        service = get_service(cluster_name, service_arn, ecs_client)
-        tasks = get_tasks(cluster_name, service_arn, ecs_client)
-
-        if is_service_stable(service, tasks):
-            return service, True
-
-        if i < attempts - 1:
-            time.sleep(interval)
-
-        last_service_snapshot = service
-        last_tasks_snapshot = tasks
+            log('Attempt {} ({:.0f}s left, {} services polled)...'.format(i+1, max(deadline - time.time(), 0), len(polling)))
+
+        services = get_services(cluster_name, polling, ecs_client)
+        missing = [arn for arn in polling if arn not in services]
+        if len(missing) > 0:
+            raise Exception('Services {} not found in cluster {}'.format(', '.join(missing), cluster_name))
+        task_count = len(task_index.tasks)
+        tasks_refreshed = [False]
+
+        for arn in polling:
+            service = services[arn]
+            if task_definitions is not None:
+                # described while waiting, so that checking the image costs nothing once stable
+                task_definitions.get(service['taskDefinition'])
+            if is_service_stable(service):
+                results[arn] = (service, 'stable')
+            elif has_failed(service):
+                log_service(service, 'The deployment of the service has failed.')
+                results[arn] = (service, 'failed')
+
+        if len(results) == len(service_arns):
+            return results
+
+        if time.time() >= deadline:
+            for arn in polling:
+                results.setdefault(arn, (services[arn], 'timeout'))
+            return results
+
+        progressed = len(task_index.tasks) != task_count or any(has_progressed(services[arn], last_services.get(arn)) for arn in polling)
+        backoff.sleep(progressed=progressed, deadline=deadline)
+
+        last_services = services
+        i += 1
 
         sys.stdout.flush()
 
-    return last_service_snapshot, False
-
-def match_image(service, full_image_name, ecs_client):
-    containers = ecs_client.describe_task_definition(taskDefinition=service['taskDefinition'])['taskDefinition']['containerDefinitions']
+def match_image(service, full_image_name, task_definitions):
+    containers = task_definitions.get(service['taskDefinition'])['containerDefinitions']
     return any(container['image'] == full_image_name for container in containers)
 
 def main():
     args = get_args()
     ecs_client = boto3.client('ecs')
 
-    service, stable = poll(cluster_name=args.cluster_name, service_arn=args.service_arn, attempts=args.attempts, interval=args.interval, ecs_client=ecs_client)
-
-    if stable:
-        log('Service {} is stable.'.format(args.service_arn))
-
-        if args.full_image_name:
-            if match_image(service=service, full_image_name=args.full_image_name, ecs_client=ecs_client):
-                log('Containers use {}'.format(args.full_image_name))
-            else:
-                log('Containers do not match {}'.format(args.full_image_name))
-                sys.exit(1)
-    else:
-        log('Service {} is still not stable after {} polls.'.format(args.service_arn, args.attempts))
+    timeout = args.timeout if args.timeout is not None else args.attempts * args.interval
+    service_arns = unique_services(args.service_arns) if args.service_arns else get_service_arns(cluster_name=args.cluster_name, ecs_client=ecs_client)
+    if len(service_arns) == 0:
+        log('There are no services in cluster {}.'.format(args.cluster_name))
+        return
+    task_definitions = TaskDefinitions(ecs_client)
+
+    results = poll(cluster_name=args.cluster_name, service_arns=service_arns, timeout=timeout, interval=args.interval, ecs_client=ecs_client,
+                   task_definitions=task_definitions if args.full_image_name else None)
+
+    succeeded = True
+    for arn in service_arns:
+        service, result = results[arn]
+        if result == 'stable':
+            log('Service {} is stable.'.format(arn))
+
+            if args.full_image_name:
+                if match_image(service=service, full_image_name=args.full_image_name, task_definitions=task_definitions):
+                    log('Containers of {} use {}'.format(arn, args.full_image_name))
+                else:
+                    log('Containers of {} do not match {}'.format(arn, args.full_image_name))
+                    succeeded = False
+        elif result == 'failed':
+            log('The deployment of service {} has failed.'.format(arn))
+            succeeded = False
+        else:
+            log('Service {} is still not stable after {} seconds.'.format(arn, timeout))
+            succeeded = False
+
+    if len(service_arns) > 1:
+        log('{} of {} services are stable.'.format(sum(1 for _, result in results.itervalues() if result == 'stable'), len(service_arns)))
+    if not succeeded:
         sys.exit(1)
 
 if __name__ == '__main__':
@@ -4,7 +4,7 @@
 # 1. Finds CloudFormation stack by --tags
 # 2. Gets ALB ARN and ALB Listener ARN from the CF stack output by --alb_key and --listener_key
 # 3. Gets ALB Listeners by ARN and builds URLs for graceful stop
-# 4. POSTs the request to the URLs to stop the service
+# 4. POSTs the request to the URLs to stop the service, --concurrency URLs at a time
 #
 # Important: Stack's tags must match FULLY with --tags
 # Important: --tags, --alb_key and --listener_key parameters are compulsory
@@ -15,11 +15,22 @@
 from __future__ import print_function
 import argparse
 import boto3
+import multiprocessing.pool
 import os
+import random
 import requests
 import sys
+import threading
+import time
 import json
 
+print_lock = threading.Lock()
+
+def log(message):
+    with print_lock:
+        print(message)
+        sys.stdout.flush()
+
 def get_stop_urls(alb_arn, alb_listener_arn, region, prefix):
     alb_client = boto3.client('elbv2', region_name=region)
 
@@ -38,7 +49,8 @@ def get_stop_urls(alb_arn, alb_listener_arn, region, prefix):
                 for value in condition['Values']:
                     paths.append(value.replace('*', 'stop'))
 
-    return ['https://' + alb_dns_name + path for path in paths if (prefix is None) or path.startswith(prefix)]
+    urls = ['https://' + alb_dns_name + path for path in paths if (prefix is None) or path.startswith(prefix)]
+    return [url for i, url in enumerate(urls) if url not in urls[:i]]
 
 
 def get_args():
@@ -47,6 +59,9 @@ def get_args():
     parser.add_argument('--alb_key', required=True)
     parser.add_argument('--listener_key', required=True)
     parser.add_argument('--prefix', required=False)
+    parser.add_argument('--concurrency', default=10, type=int, help='Number of URLs stopped at the same time')
+    parser.add_argument('--attempts', default=10, type=int, help='Maximum number of attempts per URL')
+    parser.add_argument('--timeout', default=10, type=float, help='Seconds to wait for each response')
     parser.add_argument('-v', '--verbose', default=False, action='store_true')
     return parser.parse_args()
 
@@ -87,25 +102,64 @@ def get_stack_output(stack, key, verbose):
     return matched_outputs[0]['OutputValue']
 
 
-def stop(url, attempts):
+def create_session(concurrency):
+    # one pool of keep-alive connections shared by all threads, the URLs are all on the same ALB
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.verify = False
+    return session
+
+
+def stop(url, session, attempts, timeout, min_interval=0.5, max_interval=8):
+    # retries connection errors, timeouts and unexpected status codes with exponential backoff
+    started_at = time.time()
+    result = {'url': url, 'status': None, 'attempts': 0, 'stopped': False}
     for i in range(1, attempts + 1):
+        result['attempts'] = i
         try:
-            print('Stopping: {}'.format(url))
-            r = requests.post(url, verify=False)
-        except Exception as e:
-            print('Caught exception {}'.format(e))
-            sys.exit(1)
+            log('Stopping: {}'.format(url))
+            r = session.post(url, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            log('Stop attempt {} of {} failed: {}'.format(i, url, e))
+            result['status'] = e.__class__.__name__
         else:
-            print('Received {}:{} from {}'.format(r.status_code, r.text.rstrip(), url))
+            log('Received {}:{} from {}'.format(r.status_code, r.text.rstrip(), url))
+            result['status'] = r.status_code
             if r.status_code == 200:
-                print('Successfully stopped {}'.format(url))
-                return True
+                log('Successfully stopped {}'.format(url))
+                result['stopped'] = True
+                break
             elif r.status_code in [503, 404]:
-                print('Stop attempt {} returns {} status code. Ignoring...'.format(url, r.status_code))
-                return True
+                log('Stop attempt {} returns {} status code. Ignoring...'.format(url, r.status_code))
+                result['stopped'] = True
+                break
+        if i < attempts:
+            time.sleep(random.uniform(0, min(min_interval * 2 ** (i - 1), max_interval)))
+    else:
+        log('Failed to stop {} after {} attempts'.format(url, attempts))
 
-    print('Failed to stop {} after {} attempts'.format(ip, attempts))
-    return False
+    result['seconds'] = time.time() - started_at
+    return result
+
+
+def stop_all(urls, concurrency, attempts, timeout):
+    session = create_session(concurrency)
+    pool = multiprocessing.pool.ThreadPool(max(min(len(urls), concurrency), 1))
+    try:
+        return pool.map(lambda url: stop(url, session, attempts, timeout), urls)
+    finally:
+        pool.close()
+        session.close()
+
+
+def print_results(results):
+    width = max(len(result['url']) for result in results)
+    print('\n{}  {:<8}  {:<20}  {:>8}  {:>7}'.format('URL'.ljust(width), 'RESULT', 'STATUS', 'ATTEMPTS', 'SECONDS'))
+    for result in results:
+        print('{}  {:<8}  {:<20}  {:>8}  {:>7.2f}'.format(result['url'].ljust(width), 'stopped' if result['stopped'] else 'FAILED', result['status'], result['attempts'], result['seconds']))
+    print('{} of {} stopped'.format(sum(1 for result in results if result['stopped']), len(results)))
 
 
 def main():
@@ -135,10 +189,11 @@ def main():
     if len(urls) == 0:
         print('No rules defined in the ALB - nothing to stop')
     else:
-        for url in urls:
-            if not stop(url, attempts=10):
-                print('Failed to stop {}'.format(url))
-                sys.exit(1)
+        results = stop_all(urls, concurrency=args.concurrency, attempts=args.attempts, timeout=args.timeout)
+        print_results(results)
+        if not all(result['stopped'] for result in results):
+            print('Failed to stop {}'.format(', '.join(result['url'] for result in results if not result['stopped'])))
+            sys.exit(1)
 
     print('\nDone!\n')
 
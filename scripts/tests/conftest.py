@@ -0,0 +1,91 @@
+from __future__ import print_function
+import os
+import sys
+
+# The scripts import each other by module name, as when they are run from their directory.
+#
+#   cd scripts && python -m pytest tests
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(SCRIPTS_DIR, 'ecs_deployer'), SCRIPTS_DIR]
+
+import pytest
+import benchmark
+from aws_helper import *
+from component import *
+from fake_aws import *
+from journal import *
+
+# small enough to run in well under a second of wall clock time
+TINY = {'instances': 4, 'services': 3, 'tasks': 24, 'drain_concurrency': '2'}
+
+@pytest.fixture(scope='session')
+def ecs_deployer():
+    return benchmark.load_ecs_deployer()
+
+# The benchmark's cluster (one existing B stack, its services and tasks) on a simulated clock,
+# shared with the deployer modules for the duration of a test.
+class Simulation(object):
+    def __init__(self, ecs_deployer, config_dir, scenario):
+        self.ecs_deployer = ecs_deployer
+        self.config_dir = config_dir
+        self.scenario = dict(scenario)
+        self.clock = SimulatedClock()
+        self.backend = FakeBackend(self.clock)
+        self.modules = [benchmark.helper, benchmark.metrics, benchmark.rate_limiter, benchmark.aws_helper, benchmark.cluster_state,
+                        benchmark.capacity_planner, benchmark.component, benchmark.instance_health, ecs_deployer]
+        benchmark.use_clock(self.modules, self.clock)
+        self.write_template(benchmark.get_template())
+        self.config = benchmark.get_config(config_dir, self.scenario)
+        self.existing_stack = benchmark.create_existing_cluster(self.backend, self.scenario, 'benchmark-{}-{}-B'.format(benchmark.ENVIRONMENT, benchmark.COMPONENT_NAME))
+        self.aws = AWS(benchmark.REGION, session=FakeSession(self.backend))
+        self.stack_outputs = StackOutputs(self.aws)
+
+    def stop(self):
+        self.clock.stop()
+        benchmark.restore_clock(self.modules)
+
+    def write_template(self, template):
+        with open(os.path.join(self.config_dir, benchmark.COMPONENT_NAME + '.json'), 'w') as f:
+            f.write(template)
+
+    def set_input(self, key, value):
+        self.config[':components'][':' + benchmark.COMPONENT_NAME][':inputs'][':' + key] = value
+
+    def get_component(self):
+        return Component(config=self.config, name=benchmark.COMPONENT_NAME, environment=benchmark.ENVIRONMENT, region=benchmark.REGION, stack_outputs=self.stack_outputs)
+
+    def get_journal(self):
+        return Journal(os.path.join(self.config_dir, 'journal.jsonl'))
+
+    def deploy(self, drain_concurrency=None, capacity_preflight='scale'):
+        self.ecs_deployer.deploy(component=self.get_component(), aws=self.aws, stack_outputs=self.stack_outputs, dryrun=False, size_parameters=['MinSize', 'MaxSize'],
+                                 drain_concurrency=drain_concurrency or self.scenario['drain_concurrency'], capacity_preflight=capacity_preflight, journal=self.get_journal())
+        self.stack_outputs.invalidate(self.get_component().get_stack_name_candidates())
+
+    def resume(self, drain_concurrency=None):
+        self.ecs_deployer.resume(component=self.get_component(), aws=self.aws, dryrun=False, drain_concurrency=drain_concurrency or self.scenario['drain_concurrency'],
+                                 capacity_preflight='scale', journal=self.get_journal())
+
+    def redeploy(self, wave_size, wave_timeout=900):
+        self.ecs_deployer.redeploy(component=self.get_component(), aws=self.aws, stack_outputs=self.stack_outputs, dryrun=False, wave_size=wave_size, concurrency=10,
+                                   wave_timeout=wave_timeout, journal=self.get_journal())
+
+    def get_calls(self, operation):
+        return sum(o['calls'] for o in self.aws.metrics.get_report()['operations'] if o['operation'] == operation)
+
+    def get_cluster(self):
+        return self.backend.get_cluster(benchmark.CLUSTER_NAME)
+
+    def get_new_asgs(self):
+        return [asg for asg in self.backend.asgs.itervalues() if asg['AutoScalingGroupName'] not in self.existing_stack['PhysicalIds'].values()]
+
+    def verify(self):
+        benchmark.verify(self.backend, self.scenario, self.existing_stack)
+
+@pytest.fixture
+def simulation(request, tmpdir, ecs_deployer):
+    scenario = getattr(request, 'param', TINY)
+    simulation = Simulation(ecs_deployer, str(tmpdir), scenario)
+    yield simulation
+    simulation.stop()
@@ -0,0 +1,81 @@
+from __future__ import print_function
+import json
+import pytest
+import benchmark
+from aws_helper import *
+from fake_aws import *
+
+def get_large_template():
+    template = json.loads(benchmark.get_template())
+    template['Resources'].update({'Topic{}'.format(i): {'Type': 'AWS::SNS::Topic', 'Properties': {'DisplayName': 'x' * 200}} for i in xrange(300)})
+    return json.dumps(template)
+
+def test_stack_outputs_are_looked_up_once(simulation):
+    stack_name = simulation.existing_stack['StackName']
+    stack_outputs = StackOutputs(simulation.aws)
+    stack_outputs.prefetch([stack_name, 'missing', stack_name])
+    assert stack_outputs[stack_name]['ClusterName'] == benchmark.CLUSTER_NAME
+    assert 'missing' not in stack_outputs
+    with pytest.raises(KeyError):
+        stack_outputs['missing']
+    assert simulation.get_calls('DescribeStacks') == 2
+
+def test_stack_outputs_are_looked_up_again_once_invalidated(simulation):
+    stack_name = simulation.existing_stack['StackName']
+    stack_outputs = StackOutputs(simulation.aws)
+    stack_outputs.get(stack_name)
+    stack_outputs.invalidate([stack_name])
+    stack_outputs.get(stack_name)
+    assert simulation.get_calls('DescribeStacks') == 2
+
+def test_stack_outputs_expire_after_max_age(simulation):
+    stack_name = simulation.existing_stack['StackName']
+    stack_outputs = StackOutputs(simulation.aws, max_age=60)
+    stack_outputs.get(stack_name)
+    simulation.clock.sleep(30)
+    stack_outputs.get(stack_name)
+    assert simulation.get_calls('DescribeStacks') == 1
+    simulation.clock.sleep(31)
+    stack_outputs.get(stack_name)
+    assert simulation.get_calls('DescribeStacks') == 2
+
+def test_clients_are_created_on_first_use(simulation):
+    created = []
+    session = FakeSession(simulation.backend)
+    client = session.client
+    session.client = lambda service_name, **kwargs: created.append(service_name) or client(service_name, **kwargs)
+    aws = AWS(benchmark.REGION, session=session)
+    assert created == []
+    aws.get_ecs_instances(cluster_name=benchmark.CLUSTER_NAME)
+    aws.get_ecs_instances(cluster_name=benchmark.CLUSTER_NAME)
+    assert created == ['ecs']
+
+def test_template_is_uploaded_once(simulation):
+    template = get_large_template()
+    url = simulation.aws.upload_template(bucket='templates-{region}', template=template)
+    assert simulation.aws.upload_template(bucket='templates-{region}', template=template) == url
+    assert url.startswith('https://templates-{0}.s3.{0}.amazonaws.com/ecs_deployer/templates/'.format(benchmark.REGION))
+    assert (simulation.get_calls('HeadObject'), simulation.get_calls('PutObject')) == (1, 1)
+
+    # another run finds the template in the bucket
+    aws = AWS(benchmark.REGION, session=FakeSession(simulation.backend))
+    assert aws.upload_template(bucket='templates-{region}', template=template) == url
+    assert aws.metrics.get_report()['operations'] == [dict(aws.metrics.get_report()['operations'][0], operation='HeadObject')]
+    assert simulation.backend.objects.values() == [template]
+
+def test_template_args(simulation, ecs_deployer):
+    component = simulation.get_component()
+    assert ecs_deployer.get_template_args(benchmark.get_template(), component, simulation.aws) == {'TemplateBody': benchmark.get_template()}
+    with pytest.raises(Exception) as e:
+        ecs_deployer.get_template_args(get_large_template(), component, simulation.aws)
+    assert ':template-bucket' in str(e.value)
+
+    component.template_bucket = 'templates'
+    assert ecs_deployer.get_template_args(get_large_template(), component, simulation.aws).keys() == ['TemplateURL']
+
+def test_deploy_a_large_template(simulation):
+    simulation.write_template(get_large_template())
+    simulation.config[':components'][':' + benchmark.COMPONENT_NAME][':settings'][':template-bucket'] = 'templates'
+    simulation.deploy()
+    simulation.verify()
+    assert simulation.get_calls('PutObject') == 1
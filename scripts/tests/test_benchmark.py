@@ -0,0 +1,13 @@
+from __future__ import print_function
+import benchmark
+
+def test_defaults_of_the_deployer(ecs_deployer):
+    args = benchmark.get_args([])
+    deployer_args = ecs_deployer.get_args(['deploy', benchmark.ENVIRONMENT, benchmark.COMPONENT_NAME, '--config-file', 'config.yml', '--region', benchmark.REGION])
+    assert (args.api_rate_limit, args.api_max_retries, args.capacity_preflight, args.wave_size) == (deployer_args.api_rate_limit, deployer_args.api_max_retries, deployer_args.capacity_preflight, deployer_args.wave_size)
+
+def test_regressions_against_a_baseline():
+    baseline = [{'scenario': 'small', 'succeeded': True, 'simulated_seconds': 1000, 'calls': 500, 'throttles': 0}]
+    assert benchmark.compare([dict(baseline[0], simulated_seconds=1090, calls=400)], baseline, tolerance=0.1) == []
+    assert benchmark.compare([dict(baseline[0], simulated_seconds=1200)], baseline, tolerance=0.1) == ['small simulated_seconds: 1200 (baseline 1000)']
+    assert benchmark.compare([dict(baseline[0], succeeded=False, error='timeout')], baseline, tolerance=0.1) == ['small failed: timeout']
@@ -0,0 +1,39 @@
+from __future__ import print_function
+from capacity_planner import *
+
+def get_instance(cpu, memory, ports=()):
+    return {'cpu': cpu, 'memory': memory, 'ports': set(ports)}
+
+def get_requirements(cpu, memory, port=None):
+    return {'cpu': cpu, 'memory': memory, 'ports': {('tcp', port)} if port else set()}
+
+def test_tasks_fitting_the_new_instances():
+    tasks = [get_requirements(512, 1024)] * 4
+    assert simulate_placement(tasks, [get_instance(2048, 4096)], get_instance(2048, 4096), []) == (0, [])
+
+def test_extra_instances_for_cpu_and_memory():
+    tasks = [get_requirements(512, 1024)] * 10
+    assert simulate_placement(tasks, [get_instance(2048, 4096)], get_instance(2048, 4096), []) == (2, [])
+
+def test_extra_instance_for_a_static_host_port():
+    tasks = [get_requirements(128, 128, '80')] * 3
+    assert simulate_placement(tasks, [get_instance(4096, 8192)], get_instance(4096, 8192), []) == (2, [])
+
+def test_daemon_tasks_reserve_resources_on_extra_instances():
+    tasks = [get_requirements(1024, 1024)] * 4
+    daemon = [get_requirements(1024, 1024)]
+    assert simulate_placement(tasks, [], get_instance(2048, 4096), daemon) == (4, [])
+
+def test_task_larger_than_an_instance():
+    task = get_requirements(8192, 1024)
+    assert simulate_placement([task], [get_instance(2048, 4096)], get_instance(2048, 4096), []) == (0, [task])
+
+def test_task_requirements():
+    task_definition = {
+        'cpu': '1024',
+        'containerDefinitions': [
+            {'cpu': 256, 'memory': 512, 'portMappings': [{'containerPort': 8080, 'hostPort': 80}]},
+            {'cpu': 128, 'memoryReservation': 256, 'memory': 1024, 'portMappings': [{'containerPort': 9000, 'hostPort': 0}]}
+        ]
+    }
+    assert get_task_requirements(task_definition) == {'cpu': 1024, 'memory': 768, 'ports': {('tcp', '80')}}
@@ -0,0 +1,26 @@
+from __future__ import print_function
+from cluster_state import *
+
+class AWS(object):
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.calls = 0
+
+    def get_ecs_tasks(self, cluster_name):
+        self.calls += 1
+        return list(self.tasks)
+
+def test_tasks_are_indexed_by_instance():
+    aws = AWS([{'taskArn': 't1', 'containerInstanceArn': 'i1'}, {'taskArn': 't2', 'containerInstanceArn': 'i1'}, {'taskArn': 't3', 'containerInstanceArn': 'i2'}])
+    cluster_state = ClusterState(cluster_name='web', aws=aws).refresh()
+    assert [t['taskArn'] for t in cluster_state.get_tasks('i1')] == ['t1', 't2']
+    assert cluster_state.get_task_count('i2') == 1
+    assert cluster_state.get_task_count('i3') == 0
+    assert aws.calls == 1
+
+def test_refresh_replaces_the_snapshot():
+    aws = AWS([{'taskArn': 't1', 'containerInstanceArn': 'i1'}])
+    cluster_state = ClusterState(cluster_name='web', aws=aws).refresh()
+    aws.tasks = [{'taskArn': 't2', 'containerInstanceArn': 'i2'}]
+    cluster_state.refresh()
+    assert (cluster_state.get_task_count('i1'), cluster_state.get_task_count('i2')) == (0, 1)
@@ -0,0 +1,29 @@
+from __future__ import print_function
+import pytest
+from component import *
+
+def test_matches_region():
+    assert matches_region({':region': 'eu-west-1'}, 'eu-west-1')
+    assert matches_region({':region': 'eu-west-1', ':regions': ['us-east-1']}, 'us-east-1')
+    assert not matches_region({':region': 'eu-west-1'}, 'us-east-1')
+
+def test_matches_region_with_only_regions():
+    assert matches_region({':regions': ['eu-west-1', 'us-east-1']}, 'us-east-1')
+    assert not matches_region({':regions': ['eu-west-1']}, 'us-east-1')
+
+def get_config(inputs):
+    return {':components': {':' + name: {':inputs': {k: {':component': c, ':output-key': 'Out'} for k, c in refs.iteritems()}} for name, refs in inputs.iteritems()}}
+
+def test_component_dependencies():
+    config = get_config({'app': {':Cluster': 'cluster', ':Vpc': 'vpc'}, 'cluster': {':Vpc': 'vpc'}, 'vpc': {}})
+    assert get_component_dependencies(config, ['app', 'cluster', 'vpc']) == {'app': {'cluster', 'vpc'}, 'cluster': {'vpc'}, 'vpc': set()}
+
+def test_component_dependencies_outside_the_deployment_are_ignored():
+    config = get_config({'app': {':Cluster': 'cluster'}, 'cluster': {}})
+    assert get_component_dependencies(config, ['app']) == {'app': set()}
+
+def test_circular_component_dependencies():
+    config = get_config({'a': {':B': 'b'}, 'b': {':C': 'c'}, 'c': {':A': 'a'}})
+    with pytest.raises(Exception) as e:
+        get_component_dependencies(config, ['a', 'b', 'c'])
+    assert 'a -> b -> c -> a' in str(e.value)
@@ -0,0 +1,241 @@
+from __future__ import print_function
+import json
+import os
+import pytest
+import benchmark
+
+def test_get_count(ecs_deployer):
+    assert ecs_deployer.get_count('3', 10) == 3
+    assert ecs_deployer.get_count('25%', 10) == 3
+    assert ecs_deployer.get_count('1%', 10) == 1
+
+def test_get_cluster_name_source(ecs_deployer):
+    template = json.loads(benchmark.get_template())
+    parameters = [{'ParameterKey': 'ClusterName', 'ParameterValue': 'web'}]
+    assert ecs_deployer.get_cluster_name_source(json.dumps(template), 'ClusterName', parameters) == ('name', 'web')
+
+    template['Parameters']['ClusterName']['Default'] = 'default'
+    assert ecs_deployer.get_cluster_name_source(json.dumps(template), 'ClusterName', []) == ('name', 'default')
+
+    template['Resources']['Cluster'] = {'Type': 'AWS::ECS::Cluster'}
+    template['Outputs']['ClusterName'] = {'Value': {'Ref': 'Cluster'}}
+    assert ecs_deployer.get_cluster_name_source(json.dumps(template), 'ClusterName', parameters) == ('resource', 'Cluster')
+
+    template['Outputs']['ClusterName'] = {'Value': {'Fn::ImportValue': 'cluster'}}
+    assert ecs_deployer.get_cluster_name_source(json.dumps(template), 'ClusterName', parameters) is None
+
+def test_parse_config_returns_the_last_document(ecs_deployer):
+    assert ecs_deployer.parse_config('a: 1\n---\nb: [2, 3]\n') == {'b': [2, 3]}
+    assert ecs_deployer.parse_config(':components:\n  :web: {}\n') == {':components': {':web': {}}}
+    assert ecs_deployer.parse_config('') is None
+
+def test_parse_config_uses_the_libyaml_safe_loader(ecs_deployer, monkeypatch):
+    yaml = ecs_deployer.yaml
+    loaders = []
+    class RecordingLoader(yaml.SafeLoader):
+        def __init__(self, stream):
+            loaders.append(self)
+            yaml.SafeLoader.__init__(self, stream)
+    monkeypatch.setattr(yaml, 'CSafeLoader', RecordingLoader, raising=False)
+    assert ecs_deployer.parse_config('a: 1\n---\nb: 2\n') == {'b': 2}
+    assert len(loaders) == 1
+
+    # without libyaml
+    monkeypatch.delattr(yaml, 'CSafeLoader')
+    assert ecs_deployer.parse_config('a: 1\n---\nb: 2\n') == {'b': 2}
+    assert len(loaders) == 1
+
+def test_parse_config_is_safe(ecs_deployer):
+    with pytest.raises(Exception):
+        ecs_deployer.parse_config('!!python/object/apply:os.getcwd []\n')
+
+def test_replace_moves_every_task(simulation):
+    simulation.deploy()
+    simulation.verify()
+    assert [asg['DesiredCapacity'] for asg in simulation.get_new_asgs()] == [simulation.scenario['instances']]
+
+def test_drain_keeps_the_concurrency_in_flight(simulation):
+    # instances still hosting tasks when the next batch is drained, and the size of that batch
+    batches = []
+    drain = simulation.backend.ecs_update_container_instances_state
+    def record_drain(now, cluster, containerInstances, status):
+        instances = simulation.get_cluster()['instances']
+        in_flight = [arn for arn, i in instances.iteritems() if i['status'] == 'DRAINING' and i['tasks']]
+        batches.append((len(in_flight), len(containerInstances)))
+        return drain(now, cluster, containerInstances, status)
+    simulation.backend.ecs_update_container_instances_state = record_drain
+
+    simulation.deploy(drain_concurrency='2')
+    simulation.verify()
+    assert sum(size for _, size in batches) == simulation.scenario['instances']
+    assert max(in_flight + size for in_flight, size in batches) == 2
+
+def test_unchanged_deployment_is_skipped(simulation):
+    simulation.deploy()
+    stack_count = len(simulation.backend.stacks)
+    simulation.deploy()
+    assert len(simulation.backend.stacks) == stack_count
+    assert simulation.get_calls('GetTemplate') == 1
+
+def test_change_not_affecting_the_instances_updates_in_place(simulation):
+    template = json.loads(benchmark.get_template())
+    template['Resources']['Topic'] = {'Type': 'AWS::SNS::Topic'}
+    simulation.write_template(json.dumps(template))
+    simulation.set_input('ImageId', 'ami-old')
+
+    simulation.deploy()
+    assert simulation.backend.stacks.keys() == [simulation.existing_stack['StackName']]
+    assert simulation.get_calls('UpdateStack') == 1
+    assert simulation.get_calls('CreateStack') == 0
+
+@pytest.mark.parametrize('simulation', [dict(benchmark.SCENARIOS['small'], instances=4, tasks=40)], indirect=True)
+def test_capacity_preflight_scales_the_new_instances(simulation):
+    # smaller instances than the existing ones need more of them
+    simulation.set_input('InstanceType', 't2.medium')
+    simulation.deploy(capacity_preflight='scale')
+    simulation.verify()
+    assert simulation.get_new_asgs()[0]['DesiredCapacity'] > simulation.scenario['instances']
+
+@pytest.mark.parametrize('simulation', [dict(benchmark.SCENARIOS['small'], instances=4, tasks=40)], indirect=True)
+def test_capacity_preflight_fails_before_draining(simulation):
+    simulation.set_input('InstanceType', 't2.medium')
+    with pytest.raises(Exception) as e:
+        simulation.deploy(capacity_preflight='fail')
+    assert 'Nothing has been drained' in str(e.value)
+    assert all(i['status'] == 'ACTIVE' for i in simulation.get_cluster()['instances'].itervalues())
+
+def hide_new_instances(simulation, listings):
+    # the instances of the new auto scaling groups have not registered to ECS for that many listings
+    list_instances = simulation.backend.ecs_list_container_instances
+    hidden = [0]
+    def list_registered_instances(now, cluster, status=None, nextToken=None):
+        response = list_instances(now, cluster, status, nextToken)
+        new_instance_ids = {i['InstanceId'] for asg in simulation.get_new_asgs() for i in asg['Instances']}
+        instances = simulation.get_cluster()['instances']
+        arns = [arn for arn in response['containerInstanceArns'] if instances[arn]['ec2InstanceId'] not in new_instance_ids]
+        if len(arns) < len(response['containerInstanceArns']) and (listings is None or hidden[0] < listings):
+            hidden[0] += 1
+            return dict(response, containerInstanceArns=arns)
+        return response
+    simulation.backend.ecs_list_container_instances = list_registered_instances
+    return hidden
+
+def test_capacity_preflight_waits_for_the_new_instances_to_register(simulation):
+    hidden = hide_new_instances(simulation, listings=3)
+    simulation.deploy(capacity_preflight='fail')
+    simulation.verify()
+    assert hidden[0] == 3
+
+def test_capacity_preflight_fails_when_no_new_instance_registers(simulation):
+    hide_new_instances(simulation, listings=None)
+    with pytest.raises(Exception) as e:
+        simulation.deploy(capacity_preflight='fail')
+    assert 'its capacity cannot be checked' in str(e.value)
+    assert all(i['status'] == 'ACTIVE' for i in simulation.get_cluster()['instances'].itervalues())
+
+def test_new_cluster_not_matching_is_not_warmed_up(simulation):
+    simulation.set_input('ClusterName', 'other-cluster')
+    with pytest.raises(Exception) as e:
+        simulation.deploy()
+    assert 'does not match existing cluster name' in str(e.value)
+    assert [asg['DesiredCapacity'] for asg in simulation.get_new_asgs()] == [1]
+
+def test_resume_after_an_interruption_during_the_drain(simulation):
+    calls = [0]
+    drain = simulation.backend.ecs_update_container_instances_state
+    def interrupt(now, cluster, containerInstances, status):
+        calls[0] += 1
+        if calls[0] == 2:
+            raise Exception('interrupted')
+        return drain(now, cluster, containerInstances, status)
+    simulation.backend.ecs_update_container_instances_state = interrupt
+
+    with pytest.raises(Exception):
+        simulation.deploy()
+    journal = simulation.get_journal()
+    assert journal.state['operation'] == 'replace'
+    assert journal.is_completed('create') and not journal.is_completed('drain')
+
+    # a new deployment must not start over the interrupted one
+    with pytest.raises(Exception) as e:
+        simulation.deploy()
+    assert 'resume' in str(e.value)
+
+    simulation.resume()
+    simulation.verify()
+    assert not os.path.exists(journal.path)
+    assert simulation.get_calls('CreateStack') == 1
+
+def test_drain_lists_the_tasks_of_the_whole_cluster(simulation):
+    listed = []
+    list_tasks = simulation.backend.ecs_list_tasks
+    def record_list_tasks(now, cluster, containerInstance=None, **kwargs):
+        listed.append(containerInstance)
+        return list_tasks(now, cluster, containerInstance=containerInstance, **kwargs)
+    simulation.backend.ecs_list_tasks = record_list_tasks
+
+    simulation.deploy()
+    simulation.verify()
+    assert len(listed) > 0
+    assert set(listed) == {None}
+
+def get_warm_up_results(simulation):
+    return [p['succeeded'] for p in simulation.aws.metrics.get_report()['phases'] if p['phase'] == 'warm-up']
+
+def test_new_instances_are_warmed_up_while_the_stack_is_created(simulation):
+    simulation.backend.load_balancer_create_seconds = 60
+    simulation.deploy()
+    simulation.verify()
+    assert get_warm_up_results(simulation) == [True]
+
+def test_early_warm_up_not_finishing_is_done_again_once_the_stack_is_created(simulation):
+    # the listener of the target group comes long after the auto scaling group, the instances are unused until then
+    simulation.backend.load_balancer_create_seconds = 600
+    simulation.deploy()
+    simulation.verify()
+    assert get_warm_up_results(simulation) == [False, True]
+    assert simulation.get_journal().state == {}
+
+REGIONS = ['eu-west-1', 'us-east-1', 'ap-southeast-2']
+
+def record_regions(ecs_deployer, monkeypatch, failing=()):
+    # the regions deploy_regions deploys to, in order, without deploying anything
+    deployed = []
+    def deploy_region(region, **kwargs):
+        deployed.append(region)
+        if region in failing:
+            raise Exception('{} failed'.format(region))
+    monkeypatch.setattr(ecs_deployer, 'deploy_region', deploy_region)
+    return deployed
+
+def deploy_regions(ecs_deployer, canary_regions):
+    args = ecs_deployer.get_args(['deploy', 'staging', 'web', '--config-file', 'config.yml', '--region', ','.join(REGIONS), '--canary-regions', str(canary_regions)])
+    ecs_deployer.deploy_regions(regions=REGIONS, configs={region: {} for region in REGIONS}, args=args, get_region=lambda region: (None, None))
+
+def test_canary_regions_are_deployed_first(ecs_deployer, monkeypatch):
+    deployed = record_regions(ecs_deployer, monkeypatch)
+    deploy_regions(ecs_deployer, canary_regions=1)
+    assert deployed[0] == 'eu-west-1'
+    assert sorted(deployed[1:]) == ['ap-southeast-2', 'us-east-1']
+
+def test_failed_canary_region_stops_the_deployment(ecs_deployer, monkeypatch):
+    deployed = record_regions(ecs_deployer, monkeypatch, failing=['us-east-1'])
+    with pytest.raises(Exception) as e:
+        deploy_regions(ecs_deployer, canary_regions=2)
+    assert sorted(deployed) == ['eu-west-1', 'us-east-1']
+    assert 'Failed to deploy to us-east-1, ap-southeast-2' in str(e.value)
+
+def test_without_canary_regions_every_region_is_deployed(ecs_deployer, monkeypatch):
+    deployed = record_regions(ecs_deployer, monkeypatch, failing=['eu-west-1'])
+    with pytest.raises(Exception) as e:
+        deploy_regions(ecs_deployer, canary_regions=0)
+    assert sorted(deployed) == sorted(REGIONS)
+    assert 'Failed to deploy to eu-west-1' in str(e.value)
+
+def test_negative_canary_regions_are_invalid(ecs_deployer):
+    argv = ['deploy', 'staging', 'web', '--region', ','.join(REGIONS), '--canary-regions', '-1']
+    with pytest.raises(Exception) as e:
+        ecs_deployer.get_args(argv, parser_class=ecs_deployer.JobArgumentParser, job=True)
+    assert 'Invalid arguments: --canary-regions' in str(e.value)
+    with pytest.raises(SystemExit):
+        ecs_deployer.get_args(argv + ['--config-file', 'config.yml'])
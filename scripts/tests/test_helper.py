@@ -0,0 +1,86 @@
+from __future__ import print_function
+import threading
+import pytest
+import helper
+from helper import *
+
+def test_run_dependency_graph_runs_dependencies_first():
+    started = []
+    lock = threading.Lock()
+    def func(node):
+        with lock:
+            started.append(node)
+
+    succeeded, failed, skipped = run_dependency_graph({'app': {'cluster'}, 'cluster': {'vpc'}, 'vpc': set(), 'dns': set()}, func, max_workers=4)
+    assert sorted(succeeded) == ['app', 'cluster', 'dns', 'vpc']
+    assert started.index('vpc') < started.index('cluster') < started.index('app')
+    assert (failed, skipped) == ({}, [])
+
+def test_run_dependency_graph_skips_the_dependents_of_a_failure():
+    def func(node):
+        if node == 'cluster':
+            raise Exception('cluster failed')
+
+    succeeded, failed, skipped = run_dependency_graph({'app': {'cluster'}, 'cluster': set(), 'dns': set()}, func, max_workers=1)
+    assert succeeded == ['dns']
+    assert failed.keys() == ['cluster']
+    assert skipped == ['app']
+
+def test_run_dependency_graph_limits_the_workers():
+    running = [0, 0]
+    lock = threading.Lock()
+    def func(node):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    succeeded, _, _ = run_dependency_graph({name: set() for name in 'abcdef'}, func, max_workers=2)
+    assert len(succeeded) == 6
+    assert running[1] == 2
+
+class ManualClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = ManualClock()
+    monkeypatch.setattr(helper, 'time', clock)
+    return clock
+
+def test_backoff_grows_until_progress(clock):
+    backoff = Backoff(min_interval=1, max_interval=8)
+    for _ in xrange(5):
+        backoff.sleep()
+    assert all(upper / 2.0 <= s <= upper for s, upper in zip(clock.slept, [1, 2, 4, 8, 8]))
+    backoff.sleep(progressed=True)
+    assert 0.5 <= clock.slept[-1] <= 1
+
+def test_backoff_stops_at_the_deadline(clock):
+    backoff = Backoff(min_interval=10, max_interval=10)
+    backoff.sleep(deadline=clock.now + 2)
+    backoff.sleep(deadline=clock.now - 1)
+    assert clock.slept == [2, 0]
+
+def test_attempt_until_done(clock):
+    states = iter([1, 1, 2, True])
+    assert attempt(what='test', how=lambda: next(states), timeout=100, min_interval=4, max_interval=30)
+    # the state changing from 1 to 2 resets the backoff
+    assert [4 <= clock.slept[1] <= 8, 2 <= clock.slept[2] <= 4] == [True, True]
+
+def test_attempt_times_out(clock):
+    calls = []
+    assert not attempt(what='test', how=lambda: calls.append(1), timeout=10, min_interval=1, max_interval=30)
+    assert clock.now == 1010
+    assert len(calls) == len(clock.slept) + 1
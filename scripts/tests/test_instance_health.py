@@ -0,0 +1,60 @@
+from __future__ import print_function
+from instance_health import *
+
+TARGET_GROUP_ARN = 'arn:aws:elasticloadbalancing:eu-west-1:000000000000:targetgroup/web/1'
+
+class AWS(object):
+    def __init__(self, instances, load_balancer_names=(), target_group_arns=()):
+        self.instances = instances
+        self.load_balancer_names = list(load_balancer_names)
+        self.target_group_arns = list(target_group_arns)
+        self.states = {}
+        self.calls = 0
+
+    def get_asgs(self, names):
+        return [{'Instances': [{'InstanceId': i, 'HealthStatus': status, 'LifecycleState': 'InService'} for i, status in sorted(self.instances.iteritems())],
+                 'LoadBalancerNames': self.load_balancer_names, 'TargetGroupARNs': self.target_group_arns}]
+
+    def get_elb_instance_states(self, name):
+        self.calls += 1
+        return dict(self.states.get(name, {}))
+
+    def get_target_group_states(self, arn):
+        self.calls += 1
+        return dict(self.states.get(arn, {}))
+
+def test_without_load_balancers():
+    aws = AWS({'i-1': 'Healthy', 'i-2': 'Unhealthy'})
+    health = InstanceHealth('asg', aws).refresh()
+    assert health.in_service == {'i-1'}
+    assert health.pending == {'i-2': ['auto scaling group: InService Unhealthy']}
+    assert aws.calls == 0
+
+def test_in_service_in_every_load_balancer():
+    aws = AWS({'i-1': 'Healthy', 'i-2': 'Healthy', 'i-3': 'Healthy'}, load_balancer_names=['web'], target_group_arns=[TARGET_GROUP_ARN])
+    aws.states = {'web': {'i-1': 'InService', 'i-2': 'InService'}, TARGET_GROUP_ARN: {'i-1': 'healthy', 'i-2': 'initial'}}
+    health = InstanceHealth('asg', aws).refresh()
+    assert health.in_service == {'i-1'}
+    assert health.pending == {'i-2': ['target-group web: initial'], 'i-3': ['elb web: not registered', 'target-group web: not registered']}
+    assert aws.calls == 2
+
+def test_instances_in_service_are_checked_again():
+    aws = AWS({'i-1': 'Healthy', 'i-2': 'Healthy'}, target_group_arns=[TARGET_GROUP_ARN])
+    aws.states = {TARGET_GROUP_ARN: {'i-1': 'healthy', 'i-2': 'initial'}}
+    health = InstanceHealth('asg', aws).refresh()
+    assert health.in_service == {'i-1'}
+
+    aws.states = {TARGET_GROUP_ARN: {'i-1': 'unhealthy', 'i-2': 'healthy'}}
+    health.refresh()
+    assert health.in_service == {'i-2'}
+    assert health.changes == {'in_service': {'i-2'}, 'out_of_service': {'i-1'}}
+    assert health.pending == {'i-1': ['target-group web: unhealthy']}
+
+def test_instances_unhealthy_in_the_group():
+    aws = AWS({'i-1': 'Healthy'}, target_group_arns=[TARGET_GROUP_ARN])
+    aws.states = {TARGET_GROUP_ARN: {'i-1': 'healthy'}}
+    health = InstanceHealth('asg', aws).refresh()
+    aws.instances['i-1'] = 'Unhealthy'
+    health.refresh()
+    assert health.in_service == set()
+    assert health.changes['out_of_service'] == {'i-1'}
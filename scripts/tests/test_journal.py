@@ -0,0 +1,52 @@
+from __future__ import print_function
+import os
+from journal import *
+
+def test_journal_state_is_read_back(tmpdir):
+    path = str(tmpdir.join('journals', 'benchmark-eu-west-1-cluster.jsonl'))
+    journal = Journal(path)
+    journal.set(operation='replace', new_stack_name='cluster-G')
+    journal.add('drained', ['arn-1'])
+    journal.add('drained', ['arn-2', 'arn-3'])
+    journal.add('drained', [])
+    journal.complete('create')
+
+    state = Journal(path).state
+    assert state == {'operation': 'replace', 'new_stack_name': 'cluster-G', 'drained': ['arn-1', 'arn-2', 'arn-3'], 'completed_phases': ['create']}
+    assert Journal(path).is_completed('create')
+    assert not Journal(path).is_completed('drain')
+
+def test_journal_ignores_a_line_cut_short(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    Journal(path).set(operation='create')
+    with open(path, 'a') as f:
+        f.write('{"add": {"completed_pha')
+    assert Journal(path).state == {'operation': 'create'}
+
+def test_finished_journal_is_removed(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    journal = Journal(path)
+    journal.set(operation='create')
+    journal.finish()
+    assert not os.path.exists(path)
+    assert journal.state == {}
+    assert Journal(path).state == {}
+
+def test_default_journal_dir(monkeypatch):
+    monkeypatch.delenv(JOURNAL_DIR_VARIABLE, raising=False)
+    assert get_default_journal_dir() == '.ecs_deployer'
+    monkeypatch.setenv(JOURNAL_DIR_VARIABLE, '/var/lib/ecs_deployer')
+    assert get_default_journal_dir() == '/var/lib/ecs_deployer'
+
+def test_last_deployment(tmpdir):
+    journal = Journal(str(tmpdir.join('journal.jsonl')))
+    assert journal.get_last_deployment() == {}
+    journal.set_last_deployment(deployment_hash='abc', stack={'stack_id': 'id', 'updated_at': 'now'})
+    journal.finish()
+    assert Journal(str(tmpdir.join('journal.jsonl'))).get_last_deployment() == {'deployment_hash': 'abc', 'stack': {'stack_id': 'id', 'updated_at': 'now'}}
+
+def test_deployment_hash_ignores_the_order_of_inputs_and_tags():
+    inputs = [{'ParameterKey': 'A', 'ParameterValue': '1'}, {'ParameterKey': 'B', 'ParameterValue': '2'}]
+    tags = [{'Key': 'a', 'Value': '1'}, {'Key': 'b', 'Value': '2'}]
+    assert get_deployment_hash('{"a": 1, "b": 2}', inputs, tags) == get_deployment_hash('{"b": 2, "a": 1}', inputs[::-1], tags[::-1])
+    assert get_deployment_hash('{"a": 1}', inputs, tags) != get_deployment_hash('{"a": 2}', inputs, tags)
@@ -0,0 +1,150 @@
+from __future__ import print_function
+import inspect
+import pytest
+import helper
+import poll_service_stable
+from poll_service_stable import *
+
+ARN = 'arn:aws:ecs:eu-west-1:000000000000:service/web-cluster/{}'
+TASK_ARN = 'arn:aws:ecs:eu-west-1:000000000000:task/web-cluster/{}'
+
+class ManualClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = ManualClock()
+    monkeypatch.setattr(poll_service_stable, 'time', clock)
+    return clock
+
+class Paginator(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages
+
+# The services and RUNNING tasks of a cluster. updates are applied one by one, before each describe_services.
+class ECS(object):
+    def __init__(self, names):
+        self.services = {name: {'serviceArn': ARN.format(name), 'serviceName': name} for name in names}
+        self.tasks = {}
+        self.updates = []
+        self.calls = []
+        self.task_count = 0
+        self.listed_tasks = 0
+        self.described_tasks = []
+
+    def describe_services(self, cluster, services):
+        if self.updates:
+            self.updates.pop(0)()
+        self.calls.append(services)
+        return {'services': [self.services[get_service_name(s)] for s in services], 'failures': []}
+
+    def get_paginator(self, method):
+        self.listed_tasks += 1
+        return Paginator([{'taskArns': sorted(self.tasks)}])
+
+    def describe_tasks(self, cluster, tasks):
+        self.described_tasks.append(tasks)
+        return {'tasks': [self.tasks[arn] for arn in tasks], 'failures': []}
+
+    def add_tasks(self, name, count, task_definition='web:2'):
+        for _ in xrange(count):
+            self.task_count += 1
+            arn = TASK_ARN.format(self.task_count)
+            self.tasks[arn] = {'taskArn': arn, 'group': 'service:' + name, 'taskDefinitionArn': task_definition}
+
+def get_service(name, running_count=2, rollout_state='COMPLETED', message='has reached a steady state.', created_at=200):
+    return {'serviceArn': ARN.format(name), 'serviceName': name, 'taskDefinition': 'web:2', 'desiredCount': 2, 'runningCount': running_count,
+            'deployments': [{'id': 'ecs-svc/1', 'status': 'PRIMARY', 'rolloutState': rollout_state, 'updatedAt': 100}],
+            'events': [{'id': 'event-{}'.format(created_at), 'createdAt': created_at, 'message': '(service {}) {}'.format(name, message)}]}
+
+def test_service_stable_once_it_reached_a_steady_state(clock):
+    ecs = ECS(['web'])
+    ecs.services['web'] = get_service('web', running_count=1, message='has started 1 tasks.')
+    ecs.add_tasks('web', 2)
+    ecs.updates = [lambda: None,
+                   lambda: ecs.services['web'].update(runningCount=2),
+                   lambda: ecs.services['web'].update(get_service('web', created_at=300))]
+    results = poll('web-cluster', [ARN.format('web')], timeout=60, interval=5, ecs_client=ecs)
+    assert results[ARN.format('web')][1] == 'stable'
+    assert len(ecs.calls) == 3
+    # the tasks are only listed once the service looks stable
+    assert ecs.listed_tasks == 1
+
+def test_steady_state_older_than_the_deployment(clock):
+    ecs = ECS(['web'])
+    ecs.services['web'] = get_service('web', created_at=50)
+    ecs.add_tasks('web', 2)
+    results = poll('web-cluster', [ARN.format('web')], timeout=30, interval=5, ecs_client=ecs)
+    assert results[ARN.format('web')][1] == 'timeout'
+    assert clock.now == 1030
+    assert ecs.listed_tasks == 0
+
+def test_tasks_of_another_task_definition(clock):
+    ecs = ECS(['web'])
+    ecs.services['web'] = get_service('web')
+    ecs.add_tasks('web', 1)
+    ecs.add_tasks('web', 1, task_definition='web:1')
+    old_task = [arn for arn, task in ecs.tasks.iteritems() if task['taskDefinitionArn'] == 'web:1'][0]
+    def replace_old_task():
+        del ecs.tasks[old_task]
+        ecs.add_tasks('web', 1)
+    ecs.updates = [lambda: None, replace_old_task]
+    results = poll('web-cluster', [ARN.format('web')], timeout=60, interval=5, ecs_client=ecs)
+    assert results[ARN.format('web')][1] == 'stable'
+    # the task already described is not described again
+    assert [len(arns) for arns in ecs.described_tasks] == [2, 1]
+
+def test_failed_deployment(clock):
+    ecs = ECS(['web', 'api'])
+    ecs.services['web'] = get_service('web', running_count=1, rollout_state='FAILED')
+    ecs.services['api'] = get_service('api')
+    ecs.add_tasks('api', 2)
+    results = poll('web-cluster', [ARN.format('web'), ARN.format('api')], timeout=60, interval=5, ecs_client=ecs)
+    assert {arn: result for arn, (_, result) in results.iteritems()} == {ARN.format('web'): 'failed', ARN.format('api'): 'stable'}
+    assert clock.now == 1000
+
+def test_backoff_is_the_one_of_ecs_deployer():
+    assert inspect.getsource(poll_service_stable.Backoff) == inspect.getsource(helper.Backoff)
+
+def test_task_index_describes_new_tasks_only():
+    ecs = ECS([])
+    ecs.add_tasks('web', 2)
+    index = TaskIndex('web-cluster', ecs)
+    assert index.refresh()
+    assert not index.refresh()
+    assert len(ecs.described_tasks) == 1
+
+    first = sorted(ecs.tasks)[0]
+    del ecs.tasks[first]
+    assert index.refresh()
+    assert len(ecs.described_tasks) == 1
+    ecs.add_tasks('web', 1)
+    assert index.refresh()
+    assert [len(arns) for arns in ecs.described_tasks] == [2, 1]
+    assert sorted(index.tasks) == sorted(ecs.tasks)
+    assert len(index.get_service_tasks({'serviceName': 'web'})) == 2
+
+def test_unique_services():
+    assert unique_services([ARN.format('web'), 'web', 'api', ARN.format('api'), 'web']) == [ARN.format('web'), 'api']
+
+def test_service_given_by_arn_and_by_name():
+    ecs = ECS(['web', 'api'])
+    services = get_services('web-cluster', [ARN.format('web'), 'web', 'api'], ecs)
+    assert services == {ARN.format('web'): ecs.services['web'], 'web': ecs.services['web'], 'api': ecs.services['api']}
+    assert ecs.calls == [[ARN.format('web'), 'api']]
+
+def test_services_are_described_by_ten():
+    names = ['service{}'.format(i) for i in xrange(25)]
+    ecs = ECS(names)
+    assert sorted(get_services('web-cluster', names, ecs)) == sorted(names)
+    assert [len(c) for c in ecs.calls] == [10, 10, 5]
@@ -0,0 +1,94 @@
+from __future__ import print_function
+import pytest
+import rate_limiter
+from fake_aws import FakeEvents, FakeObject
+from rate_limiter import *
+
+class ManualClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = ManualClock()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    return clock
+
+def test_token_bucket_allows_a_burst_then_the_rate(clock):
+    bucket = TokenBucket(name='ecs', rate=2, burst=3)
+    for _ in xrange(3):
+        bucket.acquire()
+    assert clock.slept == []
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.slept == [pytest.approx(0.5), pytest.approx(0.5)]
+
+def test_token_bucket_refills_over_time(clock):
+    bucket = TokenBucket(name='ecs', rate=2, burst=3)
+    for _ in xrange(3):
+        bucket.acquire()
+    clock.now += 1
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.slept == []
+
+def test_throttling_halves_the_rate_once_per_cooldown(clock):
+    bucket = TokenBucket(name='ecs', rate=8, min_rate=1, cooldown=1.0)
+    bucket.on_throttle()
+    bucket.on_throttle()
+    assert bucket.rate == 4
+    clock.now += 1
+    bucket.on_throttle()
+    assert bucket.rate == 2
+    for _ in xrange(3):
+        clock.now += 1
+        bucket.on_throttle()
+    assert bucket.rate == 1
+
+def test_successful_calls_recover_the_rate(clock):
+    bucket = TokenBucket(name='ecs', rate=10, recovery=0.1)
+    bucket.on_throttle()
+    assert bucket.rate == 5
+    for _ in xrange(3):
+        bucket.on_success()
+    assert bucket.rate == pytest.approx(8)
+    for _ in xrange(10):
+        bucket.on_success()
+    assert bucket.rate == 10
+
+def test_rate_limiter_keeps_a_bucket_per_region_and_service(clock):
+    limiter = RateLimiter(rate=5)
+    assert limiter.get_bucket('eu-west-1', 'ecs') is limiter.get_bucket('eu-west-1', 'ecs')
+    assert limiter.get_bucket('eu-west-1', 'ecs') is not limiter.get_bucket('us-east-1', 'ecs')
+    assert limiter.get_bucket('eu-west-1', 'ecs') is not limiter.get_bucket('eu-west-1', 'autoscaling')
+
+def get_client(region, service):
+    return FakeObject(meta=FakeObject(events=FakeEvents(), region_name=region, service_model=FakeObject(service_name=service)))
+
+def test_instrumented_client_acquires_a_token_per_request(clock):
+    limiter = RateLimiter(rate=4)
+    events = limiter.instrument(get_client('eu-west-1', 'ecs')).meta.events
+    for _ in xrange(5):
+        events.emit('before-send', request=None)
+    assert clock.slept == [pytest.approx(0.25)]
+
+def test_instrumented_client_adapts_the_rate_to_the_responses(clock):
+    limiter = RateLimiter(rate=4)
+    events = limiter.instrument(get_client('eu-west-1', 'ecs')).meta.events
+    bucket = limiter.get_bucket('eu-west-1', 'ecs')
+    events.emit('needs-retry', response=(FakeObject(status_code=400), {'Error': {'Code': 'ThrottlingException'}}))
+    assert bucket.rate == 2
+    # neither a connection error nor another error is a throttle or a success
+    events.emit('needs-retry', response=None)
+    events.emit('needs-retry', response=(FakeObject(status_code=400), {'Error': {'Code': 'ValidationError'}}))
+    assert bucket.rate == 2
+    events.emit('needs-retry', response=(FakeObject(status_code=200), {}))
+    assert bucket.rate == pytest.approx(2.08)
@@ -0,0 +1,44 @@
+from __future__ import print_function
+import pytest
+import benchmark
+
+def record_forced_deployments(simulation):
+    # for each forced deployment, the services forced before it which had not finished rolling out
+    forced = []
+    update_service = simulation.backend.ecs_update_service
+    def record(now, cluster, service, forceNewDeployment=False, **kwargs):
+        c = simulation.get_cluster()
+        unstable = [name for name, _ in forced if c['services'][name]['_old_tasks'] & set(c['tasks'])]
+        response = update_service(now, cluster, service, forceNewDeployment=forceNewDeployment, **kwargs)
+        forced.append((response['service']['serviceName'], unstable))
+        return response
+    simulation.backend.ecs_update_service = record
+    return forced
+
+def test_redeploy_replaces_every_task(simulation):
+    simulation.redeploy(wave_size='50%')
+    benchmark.verify_redeploy(simulation.backend, simulation.scenario)
+    assert simulation.get_calls('CreateStack') == 0
+
+def test_each_wave_waits_for_the_previous_one(simulation):
+    forced = record_forced_deployments(simulation)
+    simulation.redeploy(wave_size='1')
+    benchmark.verify_redeploy(simulation.backend, simulation.scenario)
+    assert len(forced) == len(simulation.get_cluster()['services'])
+    assert all(unstable == [] for _, unstable in forced)
+
+def test_redeploy_stops_after_a_wave_which_did_not_become_stable(simulation):
+    forced = record_forced_deployments(simulation)
+    with pytest.raises(Exception) as e:
+        simulation.redeploy(wave_size='2', wave_timeout=5)
+    assert 'did not become stable in wave 1 of 2' in str(e.value)
+    assert len(forced) == 2
+
+def test_rollout_state(ecs_deployer):
+    def service(deployments):
+        return {'deployments': [dict({'desiredCount': 2, 'runningCount': 2}, **d) for d in deployments]}
+    assert ecs_deployer.get_rollout_state(service([{'id': 'new', 'status': 'PRIMARY', 'rolloutState': 'COMPLETED'}]), 'new') == 'stable'
+    assert ecs_deployer.get_rollout_state(service([{'id': 'new', 'status': 'PRIMARY', 'rolloutState': 'IN_PROGRESS'}]), 'new') is None
+    assert ecs_deployer.get_rollout_state(service([{'id': 'new', 'status': 'PRIMARY'}, {'id': 'old', 'status': 'ACTIVE'}]), 'new') is None
+    assert ecs_deployer.get_rollout_state(service([{'id': 'new', 'status': 'PRIMARY', 'rolloutState': 'FAILED'}]), 'new') == 'failed'
+    assert ecs_deployer.get_rollout_state(service([{'id': 'rollback', 'status': 'PRIMARY'}]), 'new') == 'failed'
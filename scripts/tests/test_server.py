@@ -0,0 +1,102 @@
+from __future__ import print_function
+import json
+import os
+import stat
+import threading
+import pytest
+import server
+from server import *
+
+def wait_for(job):
+    for _ in job.follow():
+        pass
+    return job
+
+@pytest.fixture
+def deploy_server():
+    def execute(request, deploy_server):
+        log('running {}'.format(' '.join(request['argv'])))
+    return DeployServer(execute, create_region=lambda region: (None, None))
+
+@pytest.fixture
+def listen(deploy_server):
+    # starts the server on an address, returns its address
+    http_servers = []
+    def listen(address, token=None):
+        http_server = create_http_server(address, deploy_server, token)
+        http_servers.append(http_server)
+        thread = threading.Thread(target=http_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        if address.startswith('unix:'):
+            return address
+        return '127.0.0.1:{}'.format(http_server.server_address[1])
+    yield listen
+    for http_server in http_servers:
+        http_server.shutdown()
+        http_server.server_close()
+
+def test_job_log_keeps_the_last_lines(monkeypatch):
+    monkeypatch.setattr(server, 'MAX_JOB_LOG_LINES', 3)
+    job = Job('1', {'argv': []})
+    for i in xrange(5):
+        job.append(str(i))
+    job.finish(None)
+    assert list(job.follow()) == ['(2 log lines dropped)', '2', '3', '4']
+    assert job.to_dict()['log_lines'] == 5
+
+def test_job_runs_and_logs(deploy_server):
+    job = wait_for(deploy_server.submit({'argv': ['deploy', 'staging'], 'config': ''}))
+    assert job.status == 'succeeded'
+    assert any('running deploy staging' in line for line in job.follow())
+
+def test_unix_socket_only_for_the_user(tmpdir, listen):
+    address = listen('unix:' + str(tmpdir.join('server.sock')))
+    assert stat.S_IMODE(os.stat(parse_address(address)[1]).st_mode) == 0600
+    job = submit_job(address, ['deploy', 'staging'], 'config')
+    assert follow_job(address, job['id'])['status'] == 'succeeded'
+
+def test_only_json_is_accepted(tmpdir, listen):
+    address = listen('unix:' + str(tmpdir.join('server.sock')))
+    connection = UnixHTTPConnection(parse_address(address)[1])
+    connection.request('POST', '/jobs', json.dumps({'argv': ['deploy'], 'config': ''}), {'Content-Type': 'text/plain'})
+    assert connection.getresponse().status == 415
+
+def test_loopback_address_needs_a_token(listen):
+    with pytest.raises(Exception) as e:
+        listen('127.0.0.1:0')
+    assert SERVER_TOKEN_VARIABLE in str(e.value)
+
+    address = listen('127.0.0.1:0', token='secret')
+    assert send_request(address, 'GET', '/status').status == 401
+    assert send_request(address, 'GET', '/status', token='other').status == 401
+    assert send_request(address, 'GET', '/status', token='secret').status == 200
+
+def test_other_addresses_are_refused(listen):
+    with pytest.raises(Exception) as e:
+        listen('0.0.0.0:0', token='secret')
+    assert 'loopback' in str(e.value)
+
+def test_job_options(ecs_deployer):
+    argv = ['deploy', 'staging', 'web', '--region', 'eu-west-1', '--dryrun', '--canary-regions', '1', '--drain-concurrency', '25%', '--size-parameters', 'DesiredCapacity', 'MaxSize']
+    args = ecs_deployer.get_args(argv + ['--config-file', 'config.yml', '--metrics-file', 'metrics.json'])
+    job_argv = ecs_deployer.get_job_argv(args)
+    ecs_deployer.check_job_argv(job_argv)
+    job_args = ecs_deployer.get_args(job_argv, job=True)
+    assert (job_args.components, job_args.region, job_args.dryrun, job_args.canary_regions, job_args.drain_concurrency, job_args.size_parameters) == (['web'], 'eu-west-1', True, 1, '25%', ['DesiredCapacity', 'MaxSize'])
+    assert job_args.metrics_file is None
+
+@pytest.mark.parametrize('argv', [
+    ['deploy', 'staging', '--metrics-file', '/etc/passwd'],
+    ['deploy', 'staging', '--journal-dir=/tmp'],
+    ['deploy', 'staging', '--journal', '/tmp'],
+    ['deploy', 'staging', '--config-file=/etc/passwd']
+])
+def test_job_options_are_refused(ecs_deployer, argv):
+    with pytest.raises(Exception) as e:
+        ecs_deployer.check_job_argv(argv)
+    assert 'Jobs cannot set' in str(e.value)
+
+def test_ecs_deployer_imports_the_server_only_to_use_it(ecs_deployer):
+    assert not hasattr(ecs_deployer, 'DeployServer')
+    assert not hasattr(ecs_deployer, 'submit_job')
@@ -0,0 +1,79 @@
+from __future__ import print_function
+import threading
+import pytest
+import requests
+import stop_all
+
+class ManualClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = ManualClock()
+    monkeypatch.setattr(stop_all, 'time', clock)
+    return clock
+
+class Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+# answers each URL with its responses in turn, a status code or an exception to raise, then 200
+class Session(object):
+    def __init__(self, responses):
+        self.responses = responses
+        self.posted = []
+        self.lock = threading.Lock()
+
+    def post(self, url, timeout):
+        with self.lock:
+            self.posted.append(url)
+            responses = self.responses.get(url, [])
+            response = responses.pop(0) if responses else 200
+        if isinstance(response, Exception):
+            raise response
+        return Response(response)
+
+    def close(self):
+        pass
+
+URL = 'https://alb.example.com/web/stop'
+
+def test_stop_retries_until_stopped(clock):
+    session = Session({URL: [requests.exceptions.ConnectionError('refused'), requests.exceptions.Timeout('timed out'), 500]})
+    result = stop_all.stop(URL, session, attempts=10, timeout=10)
+    assert result['stopped'] and result['status'] == 200 and result['attempts'] == 4
+    assert len(clock.slept) == 3
+    assert all(0 <= seconds <= 0.5 * 2 ** i for i, seconds in enumerate(clock.slept))
+
+@pytest.mark.parametrize('status_code', [503, 404])
+def test_stop_ignores_services_already_stopped(clock, status_code):
+    result = stop_all.stop(URL, Session({URL: [status_code]}), attempts=10, timeout=10)
+    assert result['stopped'] and result['status'] == status_code and result['attempts'] == 1
+    assert clock.slept == []
+
+def test_stop_fails_after_the_attempts(clock):
+    session = Session({URL: [500] * 3})
+    result = stop_all.stop(URL, session, attempts=3, timeout=10)
+    assert not result['stopped'] and result['status'] == 500 and result['attempts'] == 3
+    # no sleep after the last attempt
+    assert len(clock.slept) == 2
+    assert result['seconds'] == pytest.approx(sum(clock.slept))
+
+def test_stop_all_keeps_the_order_of_the_urls(clock, monkeypatch):
+    urls = ['https://alb.example.com/{}/stop'.format(i) for i in xrange(20)]
+    session = Session({urls[3]: [500, 500], urls[7]: [requests.exceptions.ConnectionError('refused')] * 2})
+    monkeypatch.setattr(stop_all, 'create_session', lambda concurrency: session)
+    results = stop_all.stop_all(urls, concurrency=5, attempts=2, timeout=10)
+    assert [result['url'] for result in results] == urls
+    assert [result['url'] for result in results if not result['stopped']] == [urls[3], urls[7]]
+    assert len(session.posted) == 22
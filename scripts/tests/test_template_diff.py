@@ -0,0 +1,65 @@
+from __future__ import print_function
+import copy
+from template_diff import *
+
+TEMPLATE = {
+    'Parameters': {
+        'ImageId': {'Type': 'String'},
+        'MinSize': {'Type': 'Number', 'Default': 1},
+        'MaxSize': {'Type': 'Number', 'Default': 10},
+        'TopicName': {'Type': 'String'}
+    },
+    'Mappings': {'Regions': {'eu-west-1': {'Type': 'm4.large'}}},
+    'Resources': {
+        'LaunchConfiguration': {
+            'Type': 'AWS::AutoScaling::LaunchConfiguration',
+            'Properties': {'ImageId': {'Ref': 'ImageId'}, 'InstanceType': {'Fn::FindInMap': ['Regions', {'Ref': 'AWS::Region'}, 'Type']}}
+        },
+        'AutoScalingGroup': {
+            'Type': 'AWS::AutoScaling::AutoScalingGroup',
+            'Properties': {'LaunchConfigurationName': {'Ref': 'LaunchConfiguration'}, 'MinSize': {'Ref': 'MinSize'}, 'MaxSize': {'Ref': 'MaxSize'}}
+        },
+        'Topic': {'Type': 'AWS::SNS::Topic', 'Properties': {'TopicName': {'Ref': 'TopicName'}}}
+    }
+}
+
+def change(f):
+    template = copy.deepcopy(TEMPLATE)
+    f(template)
+    return template
+
+def get_reasons(new_template, changed_inputs=[]):
+    return get_replacement_reasons(TEMPLATE, new_template, changed_inputs, ['MinSize', 'MaxSize'])
+
+def test_instance_dependencies():
+    assert get_instance_dependencies(TEMPLATE) == {'AutoScalingGroup', 'LaunchConfiguration', 'ImageId', 'MinSize', 'MaxSize', 'Regions', 'AWS::Region'}
+
+def test_unchanged_template():
+    assert get_reasons(TEMPLATE) == []
+
+def test_change_to_other_resources_is_updated_in_place():
+    assert get_reasons(change(lambda t: t['Resources']['Topic']['Properties'].update(DisplayName='topic'))) == []
+    assert get_reasons(change(lambda t: t['Resources'].update(Queue={'Type': 'AWS::SQS::Queue'}))) == []
+    assert get_reasons(TEMPLATE, changed_inputs=['TopicName']) == []
+
+def test_change_to_the_instances_replaces_the_stack():
+    assert get_reasons(change(lambda t: t['Resources']['LaunchConfiguration']['Properties'].update(InstanceType='c4.xlarge'))) == ['resource LaunchConfiguration modified']
+    assert get_reasons(TEMPLATE, changed_inputs=['ImageId']) == ['input ImageId changed']
+    assert get_reasons(change(lambda t: t['Mappings']['Regions'].update({'us-east-1': {'Type': 'c4.xlarge'}}))) == ['mapping Regions changed']
+
+def test_size_parameters_are_updated_in_place():
+    assert get_reasons(TEMPLATE, changed_inputs=['MinSize', 'MaxSize']) == []
+    assert get_reasons(change(lambda t: t['Parameters']['MaxSize'].update(Default=20))) == []
+
+def test_references_of_intrinsic_functions():
+    assert get_references({'Fn::GetAtt': ['Topic', 'Arn']}) == {'Topic'}
+    assert get_references({'Fn::GetAtt': 'Topic.Arn'}) == {'Topic'}
+    assert get_references({'Fn::Sub': 'arn:${AWS::Partition}:${Topic.Arn}:${!Literal}'}) == {'AWS::Partition', 'Topic'}
+    assert get_references({'Fn::If': ['IsProduction', {'Ref': 'A'}, {'Ref': 'B'}]}) == {'IsProduction', 'A', 'B'}
+    assert get_references({'DependsOn': ['A', 'B'], 'Condition': 'C'}) == {'A', 'B', 'C'}
+
+def test_references_of_a_map_name_given_by_a_function():
+    assert get_references({'Fn::FindInMap': [{'Ref': 'MapName'}, 'key', 'value']}) == {'MapName'}
+
+def test_existing_template_which_cannot_be_compared():
+    assert get_replacement_reasons(None, TEMPLATE, [], []) == ['the existing template cannot be compared']